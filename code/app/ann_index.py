@@ -0,0 +1,202 @@
+import argparse
+import os
+import numpy as np
+from sklearn.cluster import MiniBatchKMeans
+from recommend_engine import TopKEngine, normalize_rows, top_k
+
+DEFAULT_INDEX_PATH = os.getenv("SONGSUGGEST_ANN_INDEX", "library_ivf.npz")
+# partitions scanned per query, trades latency for recall
+DEFAULT_NPROBE = int(os.getenv("SONGSUGGEST_NPROBE", "8"))
+
+
+######################################################################################################
+# Inverted File (IVF) Index
+######################################################################################################
+# The exact engine scans every library row per request. The IVF index clusters the normalized library
+# offline into n_lists cells and stores each cell's rows contiguously. A query only scores the nprobe
+# cells whose centroids are closest, trading a little recall for a large cut in rows scanned. Setting
+# nprobe to n_lists (or passing exact=True) falls back to a full exact scan.
+
+class IVFIndex:
+    """
+    Approximate cosine top-k search over a static library matrix.
+    :param centroids: a float32 np array (n_lists x n_features) of unit-length cell centroids
+    :param list_offsets: an int64 np array (n_lists + 1) where cell c owns rows offsets[c]:offsets[c+1]
+    :param list_ids: an int64 np array of library row positions ordered by cell
+    :param list_vectors: a float32 np array of normalized library rows ordered like list_ids
+    :param fingerprint: the library_store.library_fingerprint of the library the index was built over
+    :param quantized: an optional recommend_engine.QuantizedEngine over the same rows as list_vectors, whose
+        exact rows are list_vectors; probed cells are then scored on the quantized rows and only the best
+        candidates are re-ranked on list_vectors, which can stay memory-mapped. Not saved with the index.
+    """
+
+    def __init__(self, centroids, list_offsets, list_ids, list_vectors, fingerprint=None, quantized=None):
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_ids = list_ids
+        self.list_vectors = list_vectors
+        self.fingerprint = fingerprint
+        self.quantized = quantized
+
+    def __len__(self):
+        return self.list_ids.shape[0]
+
+    @property
+    def n_lists(self):
+        return self.centroids.shape[0]
+
+    @classmethod
+    def build(cls, matrix, n_lists=None, sample_size=100000, random_state=0):
+        """
+        Clusters a scaled library matrix into cells and lays the rows out cell by cell.
+        :param matrix: a 2D array-like (n_tracks x n_features) of scaled library rows
+        :param n_lists: number of cells, defaults to roughly the square root of the library size
+        :param sample_size: number of rows used to train the centroids
+        :param random_state: seed for the row sample and the clustering
+        :return index: a built IVFIndex
+        """
+        # cosine search runs on unit-length rows
+        normed = normalize_rows(matrix)
+        n_rows = normed.shape[0]
+        # sqrt(N) cells keeps both the centroid scan and the per-cell scan small
+        if n_lists is None:
+            n_lists = max(1, int(np.sqrt(n_rows)))
+        n_lists = min(n_lists, n_rows)
+        # train centroids on a sample so building stays cheap for very large libraries
+        rng = np.random.default_rng(random_state)
+        sample = normed[rng.choice(n_rows, size=min(sample_size, n_rows), replace=False)]
+        kmeans = MiniBatchKMeans(n_clusters=n_lists, random_state=random_state, n_init=3)
+        kmeans.fit(sample)
+        centroids = normalize_rows(kmeans.cluster_centers_)
+        # assign every row to the centroid it is most similar to
+        assignments = np.empty(n_rows, dtype=np.int64)
+        for start in range(0, n_rows, 65536):
+            block = normed[start:start + 65536]
+            assignments[start:start + 65536] = np.argmax(block @ centroids.T, axis=1)
+        # group row positions cell by cell, keeping library order inside a cell
+        list_ids = np.argsort(assignments, kind='stable')
+        counts = np.bincount(assignments, minlength=n_lists)
+        list_offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        return cls(centroids, list_offsets, list_ids, np.ascontiguousarray(normed[list_ids]))
+
+    def save(self, path):
+        """
+        Persists the index as an uncompressed .npz file.
+        :param path: destination file path
+        """
+        np.savez(path, centroids=self.centroids, list_offsets=self.list_offsets,
+                 list_ids=self.list_ids, list_vectors=self.list_vectors,
+                 fingerprint=np.asarray(self.fingerprint or ''))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads an index written by save.
+        :param path: path to the .npz file
+        :return index: an IVFIndex
+        """
+        with np.load(path) as data:
+            # indexes written before fingerprints were recorded match no library
+            fingerprint = str(data['fingerprint']) if 'fingerprint' in data.files else None
+            return cls(data['centroids'], data['list_offsets'], data['list_ids'], data['list_vectors'],
+                       fingerprint or None)
+
+    def search(self, vector, k=10, nprobe=DEFAULT_NPROBE, exact=False):
+        """
+        Finds approximately the k library rows closest to a query vector by cosine distance.
+        :param vector: a 1D (or 1 x n_features) array-like in the same scaled space as the library
+        :param k: number of recommendations to return
+        :param nprobe: number of cells to scan, higher is slower with better recall
+        :param exact: set to True to scan every cell
+        :return index: a np array of library row positions ordered from nearest to farthest
+        :return distances: a np array of the matching cosine distances
+        """
+        # normalize the query so the dot product is the cosine similarity
+        vector = normalize_rows(np.asarray(vector).reshape(1, -1))[0]
+        # probing every cell is the exact path
+        if exact or nprobe >= self.n_lists:
+            engine = self.quantized if self.quantized is not None else TopKEngine(self.list_vectors, normalized=True)
+            positions, distances = engine.query(vector, k=k)
+            return self.list_ids[positions], distances
+        # rank the cells by how close their centroid is to the query
+        cell_order = np.argsort(-(self.centroids @ vector))
+        # keep probing past nprobe if the probed cells hold fewer than k rows
+        sizes = np.diff(self.list_offsets)[cell_order]
+        n_probe = max(nprobe, int(np.searchsorted(np.cumsum(sizes), min(k, len(self)))) + 1)
+        cells = cell_order[:n_probe]
+        # gather the row ranges of the probed cells
+        ranges = [np.arange(self.list_offsets[c], self.list_offsets[c + 1]) for c in cells]
+        positions = np.concatenate(ranges)
+        if self.quantized is not None:
+            # score the probed rows on the quantized copy and re-rank the best exactly
+            positions, distances = self.quantized.query_rows(vector, positions, k=k)
+            return self.list_ids[positions], distances
+        # score only the probed rows and keep the k best
+        scores = self.list_vectors[positions] @ vector
+        best = top_k(scores, k)
+        return self.list_ids[positions[best]], 1 - scores[best]
+
+
+    def search_batch(self, matrix, k=10, nprobe=DEFAULT_NPROBE, exact=False):
+        """
+        Runs search for each of a few query vectors, e.g. the taste centroids of one user.
+        :param matrix: a 2D array-like (n_queries x n_features) in the same scaled space as the library
+        :param k: number of recommendations per query
+        :param nprobe: number of cells to scan per query
+        :param exact: set to True to scan every cell
+        :return index: a 2D np array (n_queries x k) of library row positions, nearest first
+        :return distances: a 2D np array (n_queries x k) of the matching cosine distances
+        """
+        results = [self.search(vector, k=k, nprobe=nprobe, exact=exact) for vector in np.asarray(matrix)]
+        return np.vstack([rows for rows, _ in results]), np.vstack([distances for _, distances in results])
+
+
+def load_index(path=DEFAULT_INDEX_PATH):
+    """
+    Loads an index if one has been built.
+    :param path: path to the .npz file
+    :return index: an IVFIndex, or None when no index has been built at path
+    """
+    # a missing index means serving falls back to the exact engine
+    return IVFIndex.load(path) if os.path.exists(path) else None
+
+
+######################################################################################################
+# Offline Build
+######################################################################################################
+
+def build_index(library_path, pipeline_path, out_path, n_lists=None):
+    """
+    Scales the recommendation library with the fitted pipeline and writes an IVF index for it.
+    :param library_path: a library directory, or url or path of the recommendation library csv
+    :param pipeline_path: path to the pickled pipeline whose first step is the fitted scaler
+    :param out_path: destination .npz file
+    :param n_lists: number of cells, defaults to roughly the square root of the library size
+    :return index: the built IVFIndex
+    """
+    from library_cache import read_library, read_pipeline, get_model_columns
+    from library_store import library_fingerprint
+    # load the library and the scaler exactly like the serving path does
+    recommend_library = read_library(library_path)
+    scaler = read_pipeline(pipeline_path).steps[0][1]
+    num_columns = get_model_columns(scaler, recommend_library.feature_columns)
+    # build over the scaled audio feature matrix
+    index = IVFIndex.build(scaler.transform(recommend_library.feature_frame(num_columns)), n_lists=n_lists)
+    # record which library the row positions refer to, serving refuses the index for any other
+    index.fingerprint = library_fingerprint(recommend_library)
+    index.save(out_path)
+    return index
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build the IVF index over the recommendation library.")
+    parser.add_argument('--library', default=None)
+    parser.add_argument('--pipeline', default='extended_library.pkl')
+    parser.add_argument('--out', default=DEFAULT_INDEX_PATH)
+    parser.add_argument('--lists', type=int, default=None)
+    args = parser.parse_args()
+    if args.library is None:
+        from library_cache import LIBRARY_PATH
+        args.library = LIBRARY_PATH
+    built = build_index(args.library, args.pipeline, args.out, n_lists=args.lists)
+    print(f"Wrote {built.n_lists} cells over {len(built)} tracks to {args.out}")
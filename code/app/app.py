@@ -1,6 +1,8 @@
 from user_session import UserSession
 import get_methods
 import viz_model_methods
+import library_cache
+from recommendations import CATEGORY_OPTIONS, get_recommendations
 import streamlit as st
 import pandas as pd
 import pickle
@@ -52,18 +54,65 @@ st.sidebar.info(
     "This application was created by [Chris Joyce](https://github.com/chrisJoyceDS)."
 )
 
+st.sidebar.title("Charts")
+st.sidebar.checkbox("Interactive audio profiles", key='interactive_charts')
+
 st.sidebar.title("GitHub Repository")
 st.sidebar.info(
     "[Link to the public GitHub repository](https://github.com/chrisJoyceDS/capstone_app/tree/main/capstone_app)."
 )
 
-CATEGORY_OPTIONS = ['Tracks', 'Genres', 'Artists']
 GENRES_LIST = []
+# warm the shared library, pipeline and ANN index once per process, Streamlit reruns reuse it
+library_cache.get_library()
 
 def onboarding():
     user_session = UserSession()
     return user_session
 
+def show_chart(fig, interactive):
+    if interactive:
+        st.plotly_chart(fig, use_container_width=True)
+    else:
+        st.pyplot(fig)
+
+def show_signal(df, library=None):
+    """
+    Renders the audio profile of a track set, as an interactive chart when the sidebar toggle is on.
+    :param df: a pandas DataFrame of tracks and their audio features
+    :param library: the loaded library when df holds library tracks, to plot from its precomputed bins
+    """
+    interactive = bool(st.session_state.get('interactive_charts'))
+    show_chart(viz_model_methods.visualize_signal(df, interactive=interactive, library=library), interactive)
+
+def show_recommendations(category, seeds):
+    """
+    Gets the recommendations for the seeds and renders the seed tracks, the recommendations and their
+    audio profiles.
+    :param category: one of CATEGORY_OPTIONS
+    :param seeds: a pandas DataFrame of the seeds the user entered
+    """
+    st.write('Getting recommendations...')
+    try:
+        tracks_for_model, rec_songs_full, rec_songs = get_recommendations(st.session_state.access_token, category, seeds)
+    except get_methods.NoSeedTracksError as e:
+        st.warning(str(e))
+        return
+    tracks_for_show = tracks_for_model[['artist','track_name','release_year']]
+    st.write("Below is your current searches track library which we will use to generate recommendations")
+    st.dataframe(tracks_for_show)
+    st.write("Below is the audio profile of the current track library")
+    show_signal(tracks_for_model)
+    st.write("Below are your recommended songs based on your search criteria")
+    st.dataframe(rec_songs)
+    st.write("Let's Inspect our Rec Songs Audio Feature Distribution")
+    library = library_cache.get_library()
+    show_signal(rec_songs_full, library=library)
+    if library.store.bins is not None:
+        with st.expander("Compare with the whole library"):
+            interactive = bool(st.session_state.get('interactive_charts'))
+            show_chart(viz_model_methods.visualize_library_signal(library, interactive=interactive), interactive)
+
 def main():
     user_session = onboarding()
 
@@ -102,21 +151,7 @@ def main():
                     st.table(df_genres)
                     
                 if st.button('Click when ready to continue and get recommendations'):
-                        # Here you can call your function to get recommendations
-                        st.write('Getting recommendations...')
-                        tracks_for_model = get_methods.search_genre_tracks(sp=st.session_state.access_token, genres=df_genres)
-                        tracks_for_show = tracks_for_model[['artist','track_name','release_year']]
-                        st.write("Below is your current searches track library which we will use to generate recommendations")
-                        st.dataframe(tracks_for_show)
-                        st.write("Below is the audio profile of the current track library")
-                        tracks_fig = viz_model_methods.visualize_signal(tracks_for_model)
-                        st.pyplot(tracks_fig)
-                        rec_songs_full, rec_songs = viz_model_methods.song_recommendations(tracks_for_model)
-                        st.write("Below are your recommended songs based on your search criteria")
-                        st.dataframe(rec_songs)
-                        st.write("Let's Inspect our Rec Songs Audio Feature Distribution")
-                        rec_fig = viz_model_methods.visualize_signal(rec_songs_full)
-                        st.pyplot(rec_fig)
+                        show_recommendations('Genres', df_genres)
             else:
                 genres_container.empty()
 
@@ -143,21 +178,7 @@ def main():
                     st.table(df_artists)
                     
                 if st.button('Click when ready to continue and get recommendations'):
-                        # Here you can call your function to get recommendations
-                        st.write('Getting recommendations...')
-                        tracks_for_model = get_methods.search_artist_tracks(sp=st.session_state.access_token, artists=df_artists)
-                        tracks_for_show = tracks_for_model[['artist','track_name','release_year']]
-                        st.write("Below is your current searches track library which we will use to generate recommendations")
-                        st.dataframe(tracks_for_show)
-                        st.write("Below is the audio profile of the current track library")
-                        tracks_fig = viz_model_methods.visualize_signal(tracks_for_model)
-                        st.pyplot(tracks_fig)
-                        rec_songs_full, rec_songs = viz_model_methods.song_recommendations(tracks_for_model)
-                        st.write("Below are your recommended songs based on your search criteria")
-                        st.dataframe(rec_songs)
-                        st.write("Let's Inspect our Rec Songs Audio Feature Distribution")
-                        rec_fig = viz_model_methods.visualize_signal(rec_songs_full)
-                        st.pyplot(rec_fig)
+                        show_recommendations('Artists', df_artists)
             else:
                 artists_container.empty()
                  
@@ -189,21 +210,7 @@ def main():
                     st.table(df_tracks)
 
                     if st.button('Click when ready to continue and get recommendations'):
-                        # Here you can call your function to get recommendations
-                        st.write('Getting recommendations...')
-                        tracks_for_model = get_methods.search_tracks(sp=st.session_state.access_token, tracks=df_tracks)
-                        tracks_for_show = tracks_for_model[['artist','track_name','release_year']]
-                        st.write("Below is your current searches track library which we will use to generate recommendations")
-                        st.dataframe(tracks_for_show)
-                        tracks_fig = viz_model_methods.visualize_signal(tracks_for_model)
-                        st.write("Below is the audio profile of the current track library")
-                        st.pyplot(tracks_fig)
-                        rec_songs_full, rec_songs = viz_model_methods.song_recommendations(tracks_for_model)
-                        st.write("Below are your recommended songs based on your search criteria")
-                        st.dataframe(rec_songs)
-                        st.write("Let's check the audio profile ")
-                        rec_fig = viz_model_methods.visualize_signal(rec_songs_full)
-                        st.pyplot(rec_fig)
+                        show_recommendations('Tracks', df_tracks)
             else:
                 tracks_container.empty()
     
@@ -0,0 +1,167 @@
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# largest number of ids each Spotify multi-object endpoint accepts per call
+AUDIO_FEATURES_BATCH = 100
+ARTISTS_BATCH = 50
+# largest page each Spotify paging endpoint returns
+SAVED_TRACKS_PAGE = 50
+PLAYLIST_ITEMS_PAGE = 100
+PLAYLISTS_PAGE = 50
+# concurrent requests per fan out
+MAX_WORKERS = 4
+
+
+######################################################################################################
+# Batched Fetching
+######################################################################################################
+
+def unique(ids):
+    """
+    Removes duplicate and empty ids while keeping the order they were first seen in.
+    :param ids: an iterable of Spotify ids or uris
+    :return ids: a list of unique ids
+    """
+    return list(dict.fromkeys(i for i in ids if i is not None and i == i))
+
+
+def chunk(items, size):
+    """
+    Splits a list into consecutive batches.
+    :param items: a list
+    :param size: the largest batch size
+    :return batches: a list of lists of at most size items
+    """
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def batched_fetch(fetch_batch, ids, batch_size, max_workers=MAX_WORKERS):
+    """
+    Fetches objects for a list of ids through a multi-object endpoint. Ids are deduplicated, packed into the
+    largest batches the endpoint allows and the batches are requested concurrently.
+    :param fetch_batch: a function taking a list of ids and returning a list of objects in the same order,
+        with None for ids Spotify does not know
+    :param ids: an iterable of Spotify ids or uris, duplicates allowed
+    :param batch_size: the largest number of ids fetch_batch accepts
+    :param max_workers: the largest number of batches in flight at once
+    :return objects: a dict of id to fetched object (or None), in first-seen id order
+    """
+    batches = chunk(unique(ids), batch_size)
+    if not batches:
+        return {}
+    # a single batch does not need a thread pool
+    if len(batches) == 1 or max_workers <= 1:
+        results = [fetch_batch(batch) for batch in batches]
+    else:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(batches))) as executor:
+            results = list(executor.map(fetch_batch, batches))
+    # the endpoints answer positionally, so pair every id with the object at its position
+    objects = {}
+    for batch, result in zip(batches, results):
+        objects.update(zip(batch, result))
+    return objects
+
+
+######################################################################################################
+# Concurrent Seed Resolution
+######################################################################################################
+
+def resolve_concurrently(resolve, seeds, max_workers=MAX_WORKERS):
+    """
+    Resolves every seed on a bounded thread pool. Results keep the order of the seeds, and a seed that
+    raises is logged and resolved to None instead of aborting the others.
+    :param resolve: a function taking one seed and returning its result
+    :param seeds: a list of seeds, e.g. dicts of track name, artist and year
+    :param max_workers: the largest number of seeds resolved at once
+    :return results: a list with one result (or None) per seed, in seed order
+    """
+    def safe_resolve(seed):
+        try:
+            return resolve(seed)
+        except Exception:
+            logger.warning("Could not resolve seed %r", seed, exc_info=True)
+            return None
+
+    if len(seeds) <= 1 or max_workers <= 1:
+        return [safe_resolve(seed) for seed in seeds]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(seeds))) as executor:
+        # map yields results in submission order no matter which seed finishes first
+        return list(executor.map(safe_resolve, seeds))
+
+
+######################################################################################################
+# Concurrent Pagination
+######################################################################################################
+
+def iter_pages(fetch_page, page_size, max_workers=MAX_WORKERS):
+    """
+    Yields every page of a Spotify paging endpoint in order. The first page reveals the total, then the
+    remaining pages are requested concurrently by offset instead of following next one page at a time.
+    :param fetch_page: a function taking limit and offset and returning a Spotify paging object
+    :param page_size: the largest limit the endpoint accepts
+    :param max_workers: the largest number of pages in flight at once
+    :return pages: a generator of lists of items, one per page, in offset order
+    """
+    first = fetch_page(page_size, 0)
+    yield first['items']
+    # the first page already holds everything
+    total = first.get('total') or 0
+    offsets = list(range(page_size, total, page_size))
+    if not offsets:
+        return
+    if max_workers <= 1:
+        for offset in offsets:
+            yield fetch_page(page_size, offset)['items']
+        return
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(offsets))) as executor:
+        # keep at most max_workers pages in flight ahead of the consumer, so a slow consumer never holds
+        # more than a window of pages in memory, and yield them in offset order
+        pending = deque()
+        for offset in offsets:
+            pending.append(executor.submit(fetch_page, page_size, offset))
+            if len(pending) >= max_workers:
+                yield pending.popleft().result()['items']
+        while pending:
+            yield pending.popleft().result()['items']
+
+
+def paginate(fetch_page, page_size, max_workers=MAX_WORKERS):
+    """
+    Fetches every item of a Spotify paging endpoint, see iter_pages.
+    :param fetch_page: a function taking limit and offset and returning a Spotify paging object
+    :param page_size: the largest limit the endpoint accepts
+    :param max_workers: the largest number of pages in flight at once
+    :return items: a list of every item in offset order
+    """
+    return [item for page in iter_pages(fetch_page, page_size, max_workers) for item in page]
+
+
+def paginate_many(fetch_page, keys, page_size, max_workers=MAX_WORKERS):
+    """
+    Fetches every item of many paged resources, e.g. the items of every playlist, on one bounded pool. The
+    first page of every resource is requested concurrently, then every remaining page of every resource.
+    :param fetch_page: a function taking a key, limit and offset and returning a Spotify paging object
+    :param keys: an iterable of resource keys, e.g. playlist ids, duplicates are fetched once
+    :param page_size: the largest limit the endpoint accepts
+    :param max_workers: the largest number of pages in flight at once
+    :return items: a dict of key to a list of its items in offset order, in first-seen key order
+    """
+    def fetch_all(units):
+        if len(units) <= 1 or max_workers <= 1:
+            return [fetch_page(key, page_size, offset) for key, offset in units]
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(units))) as executor:
+            return list(executor.map(lambda unit: fetch_page(unit[0], page_size, unit[1]), units))
+
+    keys = unique(keys)
+    # the first pages reveal every resource's total
+    first_pages = fetch_all([(key, 0) for key in keys])
+    items = {key: list(page['items']) for key, page in zip(keys, first_pages)}
+    units = [(key, offset) for key, page in zip(keys, first_pages)
+             for offset in range(page_size, page.get('total') or 0, page_size)]
+    # pages come back in unit order, so extending in that order keeps every resource in offset order
+    for (key, _), page in zip(units, fetch_all(units)):
+        items[key].extend(page['items'])
+    return items
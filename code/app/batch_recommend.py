@@ -0,0 +1,170 @@
+import argparse
+import functools
+import json
+import logging
+import multiprocessing
+import os
+import time
+import library_cache
+import metadata_cache
+import spotify_client
+from recommendations import CATEGORY_OPTIONS, get_recommendations, make_seeds, to_records
+
+logger = logging.getLogger(__name__)
+
+PROCESSES = os.cpu_count() or 1
+# seed lists handed to a worker at a time
+CHUNK_SIZE = 8
+# category names are accepted in any case
+_CATEGORIES = {category.casefold(): category for category in CATEGORY_OPTIONS}
+
+
+######################################################################################################
+# Offline Batch Recommendations
+######################################################################################################
+# Recommends songs for a JSONL file of seed lists, one per line:
+#
+#   {"id": "user-1", "category": "Artists", "seeds": [{"artist_name": "Daft Punk"}], "k": 10}
+#
+# The library is loaded once in the parent and the pool is forked from it, so every worker shares the
+# memory-mapped library and the engines built over it copy-on-write instead of loading its own copy.
+# Results are appended to the output JSONL as they finish and the output doubles as the checkpoint: a
+# rerun skips every id already written, so a crash only loses the seed lists that were in flight.
+
+def read_done(output_path):
+    """
+    Collects the ids already written to an output file, dropping a partial last line left by a crash.
+    :param output_path: path of the output JSONL
+    :return done: a set of ids
+    """
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, 'rb+') as f:
+        valid = 0
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            try:
+                done.add(json.loads(line)['id'])
+            except (ValueError, KeyError):
+                break
+            valid += len(line)
+        # anything after the last complete result is rewritten on this run
+        f.truncate(valid)
+    return done
+
+
+def read_requests(input_path, done=frozenset()):
+    """
+    Streams the seed lists of an input file that are not done yet.
+    :param input_path: path of the input JSONL
+    :param done: ids to skip
+    :return requests: a generator of request dicts with an id
+    """
+    with open(input_path) as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError:
+                logger.warning("Skipping malformed line %s of %s", line_number, input_path)
+                continue
+            # a seed list without an id is identified by its line number
+            request.setdefault('id', line_number)
+            if request['id'] not in done:
+                yield request
+
+
+# each worker's Spotify client, created after the fork
+_sp = None
+
+
+def _init_worker(sp, processes):
+    global _sp
+    if sp is None:
+        # split the Web API rate limit between the workers, every process has its own bucket
+        from spotipy.oauth2 import SpotifyClientCredentials
+        bucket = spotify_client.TokenBucket(spotify_client.REQUESTS_PER_SECOND / processes,
+                                            max(1, spotify_client.BURST // processes))
+        sp = spotify_client.make_client(bucket=bucket, client_credentials_manager=SpotifyClientCredentials())
+    else:
+        # stub answers stay in memory instead of the shared cache file
+        metadata_cache.set_default_cache(metadata_cache.MetadataCache(':memory:'))
+    _sp = sp
+
+
+def recommend_one(request, k=10):
+    """
+    Recommends songs for one seed list.
+    :param request: a dict with id, category, seeds and optionally k
+    :param k: number of recommendations when the request does not give one
+    :return result: a JSON-serializable dict with either the recommendations or an error
+    """
+    try:
+        category = _CATEGORIES.get(str(request.get('category', '')).casefold(), request.get('category'))
+        seeds = make_seeds(category, request.get('seeds'))
+        tracks_for_model, rec_songs_full, rec_songs = get_recommendations(_sp, category, seeds,
+                                                                           k=int(request.get('k', k)))
+    except Exception as e:
+        logger.warning("Seed list %r failed", request.get('id'), exc_info=True)
+        return {'id': request['id'], 'error': f"{type(e).__name__}: {e}"}
+    return {'id': request['id'], 'category': category, 'seed_tracks': to_records(tracks_for_model),
+            'recommendations': to_records(rec_songs_full)}
+
+
+def run(input_path, output_path, processes=PROCESSES, k=10, stub=False, chunk_size=CHUNK_SIZE):
+    """
+    Recommends songs for every seed list of the input not already in the output.
+    :param input_path: path of the input JSONL of seed lists
+    :param output_path: path of the output JSONL, appended to, failures go to <output_path>.errors
+    :param processes: number of worker processes
+    :param k: number of recommendations per seed list
+    :param stub: answer Spotify calls from the local library instead of the Web API
+    :param chunk_size: seed lists handed to a worker at a time
+    :return counts: a dict of written, failed and skipped seed lists
+    """
+    done = read_done(output_path)
+    errors_path = output_path + '.errors'
+    # load the library before forking so the workers share it
+    library = library_cache.get_library()
+    sp = None
+    if stub:
+        from stub_spotify import StubSpotify
+        sp = StubSpotify.from_library(library)
+    # fork shares the warm library, other start methods load it again in each worker
+    method = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else None
+    context = multiprocessing.get_context(method)
+    counts = {'written': 0, 'failed': 0, 'skipped': len(done)}
+    started = time.monotonic()
+    with context.Pool(processes, initializer=_init_worker, initargs=(sp, processes)) as pool, \
+            open(output_path, 'a') as output, open(errors_path, 'w') as errors:
+        requests = read_requests(input_path, done)
+        results = pool.imap_unordered(functools.partial(recommend_one, k=k), requests, chunk_size)
+        for result in results:
+            # a failed seed list is logged apart from the output so the next run retries it, the errors
+            # file is rewritten every run so it only lists the seed lists that are still failing
+            target = errors if 'error' in result else output
+            target.write(json.dumps(result) + '\n')
+            target.flush()
+            counts['failed' if 'error' in result else 'written'] += 1
+            if (counts['written'] + counts['failed']) % 1000 == 0:
+                logger.info("%s seed lists done in %.0fs", counts['written'] + counts['failed'],
+                            time.monotonic() - started)
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Recommend songs for a JSONL file of seed lists.")
+    parser.add_argument('input')
+    parser.add_argument('output')
+    parser.add_argument('--processes', type=int, default=PROCESSES)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--stub', action='store_true',
+                        help="answer Spotify calls from the local library instead of the Web API")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    counts = run(args.input, args.output, args.processes, args.k, args.stub, args.chunk_size)
+    print(f"written {counts['written']}, failed {counts['failed']}, skipped {counts['skipped']} already done")
@@ -0,0 +1,174 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+try:
+    from library_store import StringColumn
+except ImportError:
+    # imported as app.chunk_store by the data collection code one directory up
+    from app.library_store import StringColumn
+
+MANIFEST_NAME = "chunks.json"
+# rows buffered before a chunk is written
+CHUNK_ROWS = 5000
+
+
+######################################################################################################
+# Chunked On-Disk Frames
+######################################################################################################
+# A large user library is ingested page by page: each page of track objects is flattened as it arrives,
+# buffered up to chunk_rows rows and written to disk as one columnar .npz chunk, so memory is bounded by
+# one chunk instead of the whole library. Readers get the chunks back one dataframe at a time.
+#
+#   <directory>/chunks.json        columns, dtypes and row count of every chunk, written last
+#   <directory>/chunk-00000.npz    one array per column, string columns as UTF-8 bytes plus offsets
+
+def _column_arrays(key, values):
+    # strings are stored as a library_store.StringColumn so chunks load without pickle and cost the bytes
+    # of their values instead of rows x longest value, missing strings become ''
+    if _is_text(values.dtype):
+        column = StringColumn.from_values(values.fillna('').astype(str))
+        return {key: column.data, f"{key}.offsets": column.offsets}
+    return {key: values.to_numpy()}
+
+
+def _is_text(dtype):
+    return not (pd.api.types.is_numeric_dtype(dtype) or pd.api.types.is_bool_dtype(dtype))
+
+
+class ChunkWriter:
+    """
+    Buffers rows and writes them to a directory of columnar chunks.
+    :param path: destination directory, created if missing, chunks already there are replaced
+    :param chunk_rows: rows per chunk
+    """
+
+    def __init__(self, path, chunk_rows=CHUNK_ROWS):
+        self.path = path
+        self.chunk_rows = chunk_rows
+        self.chunks = []
+        self.columns = None
+        self.dtypes = None
+        self._buffer = []
+        os.makedirs(path, exist_ok=True)
+        # a stale manifest would describe chunks this writer is about to replace
+        if os.path.exists(os.path.join(path, MANIFEST_NAME)):
+            os.remove(os.path.join(path, MANIFEST_NAME))
+
+    def write_rows(self, rows):
+        """
+        Adds rows, writing a chunk every time chunk_rows rows are buffered.
+        :param rows: a list of flat dicts, e.g. from flatten_tracks
+        """
+        self._buffer.extend(rows)
+        while len(self._buffer) >= self.chunk_rows:
+            self._flush(self._buffer[:self.chunk_rows])
+            self._buffer = self._buffer[self.chunk_rows:]
+
+    def write_frame(self, df):
+        """
+        Writes a dataframe as one chunk, e.g. a chunk transformed by a downstream step.
+        :param df: a pandas DataFrame
+        """
+        if len(df):
+            self._flush(df)
+
+    def _flush(self, rows):
+        df = rows if isinstance(rows, pd.DataFrame) else pd.DataFrame(rows)
+        if self.columns is None:
+            self.columns = list(df.columns)
+            self.dtypes = {name: str(dtype) for name, dtype in df.dtypes.items()}
+        # every chunk has the columns of the first, missing ones are filled
+        df = df.reindex(columns=self.columns)
+        name = f"chunk-{len(self.chunks):05d}.npz"
+        arrays = {}
+        for i, column in enumerate(self.columns):
+            arrays.update(_column_arrays(str(i), df[column]))
+        np.savez(os.path.join(self.path, name), **arrays)
+        self.chunks.append({'name': name, 'rows': len(df)})
+
+    def close(self):
+        """
+        Writes the remaining rows and the manifest.
+        :return chunks: a ChunkedFrame over the written chunks
+        """
+        if self._buffer:
+            self._flush(self._buffer)
+            self._buffer = []
+        manifest = {'columns': self.columns or [], 'dtypes': self.dtypes or {}, 'chunks': self.chunks}
+        tmp_path = os.path.join(self.path, MANIFEST_NAME + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, os.path.join(self.path, MANIFEST_NAME))
+        return ChunkedFrame(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        # only a complete ingestion gets a manifest
+        if exc_type is None:
+            self.close()
+
+
+class ChunkedFrame:
+    """
+    A dataframe stored as columnar chunks on disk, read one chunk at a time.
+    :param path: a directory written by ChunkWriter
+    """
+
+    def __init__(self, path):
+        manifest_path = os.path.join(path, MANIFEST_NAME)
+        if not os.path.exists(manifest_path):
+            raise ValueError(f"{path} is not a complete chunk directory, it has no {MANIFEST_NAME}.")
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        self.path = path
+        self.columns = manifest['columns']
+        self.dtypes = manifest['dtypes']
+        self.chunks = manifest['chunks']
+
+    def __len__(self):
+        return sum(chunk['rows'] for chunk in self.chunks)
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            yield self.read_chunk(chunk['name'])
+
+    def read_chunk(self, name):
+        """
+        :param name: a chunk file name from chunks
+        :return df: the chunk as a pandas DataFrame with the original columns
+        """
+        columns = {}
+        with np.load(os.path.join(self.path, name)) as data:
+            for i, column in enumerate(self.columns):
+                if f"{i}.offsets" in data.files:
+                    strings = StringColumn(data[str(i)], data[f"{i}.offsets"])
+                    # string columns come back with the string dtype of the frame they were written from
+                    columns[column] = pd.Series(strings[np.arange(len(strings))]).astype(self.dtypes[column])
+                else:
+                    columns[column] = data[str(i)]
+        return pd.DataFrame(columns, columns=self.columns)
+
+    def to_frame(self):
+        """
+        Loads every chunk into one dataframe, for libraries small enough to hold in memory.
+        :return df: a pandas DataFrame
+        """
+        frames = list(self)
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=self.columns)
+
+
+def write_chunks(pages, path, chunk_rows=CHUNK_ROWS):
+    """
+    Streams pages of rows to a chunk directory.
+    :param pages: an iterable of lists of flat dicts, consumed lazily
+    :param path: destination directory
+    :param chunk_rows: rows per chunk
+    :return chunks: a ChunkedFrame over the written chunks
+    """
+    with ChunkWriter(path, chunk_rows) as writer:
+        for rows in pages:
+            writer.write_rows(rows)
+    return ChunkedFrame(path)
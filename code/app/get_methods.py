@@ -1,51 +1,71 @@
 # Next, Tracks, and Playlist Code Referenced from:
 # https://stackoverflow.com/questions/39086287/spotipy-how-to-read-more-than-100-tracks-from-a-playlist
+from collections import defaultdict
 from user_session import UserSession
+from batch_methods import batched_fetch, resolve_concurrently, AUDIO_FEATURES_BATCH, ARTISTS_BATCH, MAX_WORKERS
+import metadata_cache
 import spotipy
 import spotipy.oauth2 as oauth2
 import pandas as pd
 from spotipy.exceptions import SpotifyException
 
 
+class NoSeedTracksError(ValueError):
+    """
+    Raised when none of the seeds resolve to a Spotify track, e.g. an unknown genre or misspelled artist.
+    The seeds are at fault, not the service.
+    """
+
+
 ######################################################################################################
 # Search for Track
 ######################################################################################################
-def search_genre_tracks(sp: object, genres):
-    tracks_to_flat = []
-    
-    for i, genre in genres.iterrows():
+def search_genre_tracks(sp: object, genres, max_workers=MAX_WORKERS):
+
+    def resolve(genre):
         q = f"genre:{genre['genre']}"
         results = sp.search(q=q, type='track')
-        tracks_to_flat.extend(results['tracks']['items'])
-        
+        return results['tracks']['items']
+
+    # search every genre concurrently, keeping the order the genres were entered in
+    resolved = resolve_concurrently(resolve, genres.to_dict('records'), max_workers)
+    tracks_to_flat = [track for tracks in resolved if tracks for track in tracks]
+
     tracks_for_model = prepare_tracks_for_model(sp, tracks_to_flat)  
 
     return tracks_for_model
 
 
 
-def search_artist_tracks(sp: object, artists):
-    tracks_to_flat = []
-    
-    for i, artist in artists.iterrows():
+def search_artist_tracks(sp: object, artists, max_workers=MAX_WORKERS):
+
+    def resolve(artist):
         q = f"artist:{artist['artist_name']}"
         results = sp.search(q=q, type='artist')
         top_tracks = sp.artist_top_tracks(artist_id=results['artists']['items'][0]['uri'],country='US')
-        tracks_to_flat.extend(top_tracks['tracks'])
-        
+        return top_tracks['tracks']
+
+    # resolve every artist and their top tracks concurrently, keeping the order the artists were entered in
+    resolved = resolve_concurrently(resolve, artists.to_dict('records'), max_workers)
+    tracks_to_flat = [track for tracks in resolved if tracks for track in tracks]
+
     tracks_for_model = prepare_tracks_for_model(sp, tracks_to_flat)   
 
     return tracks_for_model
 
 
-def search_tracks(sp: object, tracks):
-    tracks_to_flat = []
-    for i, track in tracks.iterrows():
+def search_tracks(sp: object, tracks, max_workers=MAX_WORKERS):
+
+    def resolve(track):
         q = f"track:{track['name']} artist:{track['artist']} year:{track['year']}"
         results = sp.search(q=q, type='track')
-        track_object = sp.track(results['tracks']['items'][0]['id'])
-        tracks_to_flat.append(track_object)
-        
+        # search results are already full track objects, no second lookup needed
+        return results['tracks']['items'][0]
+
+    # search every track concurrently, keeping the order the tracks were entered in
+    resolved = resolve_concurrently(resolve, tracks.to_dict('records'), max_workers)
+    tracks_to_flat = [track for track in resolved if track is not None]
+
     tracks_for_model = prepare_tracks_for_model(sp, tracks_to_flat)
 
     return tracks_for_model
@@ -78,23 +98,24 @@ def flatten_tracks(tracks: list):
     return flattened_tracks
 
 # Audio Track Features Retrieval
-def get_track_audio_features(sp, df):
+def get_track_audio_features(sp, df, cache=None):
     """
     Retrieves a set of track audio features from a provided dataframe and merges the results
     :param sp: a spotipy.Spotify object with an access token for the user
     :param df: a pandas Dataframe containing a given users tracks and associated track metadata features.
+    :param cache: an optional metadata_cache.MetadataCache, defaults to the process-wide cache
     :return tracks_w_features: a pandas DataFrame containing a users tracks, track metadata and track audio features.
     """
-    # Use List Comprehension to get List of all track ids
-    track_ids = [track for track in df['id']]
-    # set list for audio features
-    audio_features = []
-    # iterate through list of track ids 100 at a time to account for api call limit
-    for i in range(0, len(track_ids)):
-        # get batch of audio features for each chunk of 100
-        audio_features_item = sp.audio_features(track_ids[i])
-        # add batch to audio features
-        audio_features += audio_features_item
+    cache = cache or metadata_cache.get_default_cache()
+    # serve cached features and fetch the rest in batches of 100, requesting the batches concurrently
+    audio_features = cache.read_through(
+        'audio_features', df['id'],
+        lambda missing: batched_fetch(lambda batch: sp.audio_features(tracks=batch), missing, AUDIO_FEATURES_BATCH)
+    )
+    # keep the tracks Spotify returned features for
+    audio_features = [features for features in audio_features.values() if features is not None]
+    if not audio_features:
+        return pd.DataFrame(columns=['id'])
     # turn audio features into a df
     audio_features_df = pd.DataFrame(audio_features)
     # drop columns we dont need
@@ -103,32 +124,36 @@ def get_track_audio_features(sp, df):
     return audio_features_df
     
 
-def get_genres(sp, df):
+def get_genres(sp, df, cache=None):
     """
-    Retrieves the user's saved or liked tracks from their profile and returns a list of JSON Track Objects.
+    Looks up the genres of every track's primary artist and adds them as a genres column.
     :param sp: a spotipy.Spotify object with an access token for the user.
-    :return tracks: a list of returned JSON Track Objects from the spotipy api call.
+    :param df: a pandas DataFrame of tracks with an artist_uri column.
+    :param cache: an optional metadata_cache.MetadataCache, defaults to the process-wide cache
+    :return df: the same tracks with a genres column of lists, empty when Spotify lists none.
     """
-    # Use List Comprehension to get List of all track ids
-    artist_uris = [track for track in df['artist_uri']]
-    # set list for audio features
-    genres = []
-    # iterate through list of track ids 100 at a time to account for api call limit
-    for uri in artist_uris:
-        # get batch of audio features for each chunk of 100
-        artist = sp.artist(uri)
-        try:# add batch to audio features
-            genres.append({'artist_uri': artist['uri'], 'genres': artist['genres']})
-        except:
-            genres.append({'artist_uri': artist['uri'], 'genres': []})
-    df_genres = pd.DataFrame(genres)
-    df = pd.merge(df,df_genres, on='artist_uri', how='left')
+    cache = cache or metadata_cache.get_default_cache()
+
+    def fetch(missing):
+        # resolve each unique artist once, 50 artists per call, requesting the batches concurrently
+        artists = batched_fetch(lambda batch: sp.artists(batch)['artists'], missing, ARTISTS_BATCH)
+        # unknown artists get no genres
+        return {uri: (artist or {}).get('genres', []) for uri, artist in artists.items()}
+
+    # map artist uri to its genres, reading through the cache
+    genres = defaultdict(list, cache.read_through('artist_genres', df['artist_uri'], fetch))
+    # join the genres back onto every track of the artist
+    df = df.copy()
+    df['genres'] = df['artist_uri'].map(genres)
     return df
 
 
 def prepare_tracks_for_model(sp, tracks_to_flat):
     
     tracks_for_model = pd.DataFrame(flatten_tracks(tracks_to_flat))
+    # every seed failed or matched nothing, there is no taste signal to recommend from
+    if tracks_for_model.empty:
+        raise NoSeedTracksError("None of the seeds matched a Spotify track, check the spelling and try again.")
     tracks_for_model['explicit'] = tracks_for_model['explicit'].apply(lambda x: 1 if x==True else 0)
     tracks_for_model['release_year'] = pd.to_datetime(tracks_for_model['release_date'],errors='coerce').dt.year
     tracks_for_model['release_year']=tracks_for_model['release_year'].astype(int)
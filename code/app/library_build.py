@@ -0,0 +1,131 @@
+import argparse
+import numpy as np
+import pandas as pd
+from library_cache import LIBRARY_URL, PIPELINE_PATH, read_pipeline, get_model_columns
+from ann_index import IVFIndex
+from library_store import LibraryStore, write_store, scaler_fingerprint
+from recommend_engine import QUANTIZED_DTYPES, normalize_rows, quantize
+from viz_model_methods import SIGNAL_FEATURES, QUANTILES
+
+# histogram bins per plotted feature, bin indices are stored as uint8
+HISTOGRAM_BINS = 64
+
+
+######################################################################################################
+# Library Build
+######################################################################################################
+# Converts rec_library_full.csv into the columnar library directory read by library_store. Run it once
+# whenever the csv or the fitted pipeline changes, then point SONGSUGGEST_LIBRARY at the output (or keep
+# the default 'library'). The library is scaled here, so serving only ever scales the user's mean vector.
+# With partitions, the scaled library is also clustered and every file is written cluster by cluster, so
+# the query path can scan just the few contiguous partitions nearest to the user instead of every row.
+# That search is approximate (SONGSUGGEST_NPROBE trades latency for recall), so partitioning is opt in and
+# a library built without it is always searched exactly.
+# With quantize, an int8 or float16 copy of the scaled library is written for the serving scan.
+# Every build also bins the plotted audio features per track, so the profile of any set of library tracks
+# is a bincount over their rows instead of a pass over their raw values.
+
+def prescale(store, scaler):
+    """
+    Scales and L2-normalizes the model columns of a library once and records which scaler did it.
+    :param store: a LibraryStore
+    :param scaler: the fitted StandardScaler from the pipeline
+    :return store: the same LibraryStore with scaled, scaled_columns and fingerprint set
+    """
+    columns = get_model_columns(scaler, store.feature_columns)
+    store.scaled = normalize_rows(scaler.transform(store.feature_frame(columns)))
+    store.scaled_columns = columns
+    store.fingerprint = scaler_fingerprint(scaler, columns)
+    return store
+
+
+def partition(store, n_partitions=None):
+    """
+    Clusters the pre-scaled library and reorders its rows partition by partition.
+    :param store: a LibraryStore with a scaled matrix
+    :param n_partitions: number of partitions, defaults to roughly the square root of the library size
+    :return store: a new LibraryStore in partition order with partition centroids and offsets set
+    """
+    # the IVF build does the clustering, its cell order becomes the library's row order
+    cells = IVFIndex.build(store.scaled, n_lists=n_partitions)
+    partitioned = store.reorder(cells.list_ids)
+    partitioned.partition_centroids = cells.centroids
+    partitioned.partition_offsets = cells.list_offsets
+    return partitioned
+
+
+def add_quantized(store, dtype='int8'):
+    """
+    Adds a quantized copy of the pre-scaled library for the serving scan.
+    :param store: a LibraryStore with a scaled matrix
+    :param dtype: 'int8' or 'float16'
+    :return store: the same LibraryStore with quantized, quant_scale and quant_offset set
+    """
+    store.quantized, store.quant_scale, store.quant_offset = quantize(store.scaled, dtype)
+    return store
+
+
+def add_distributions(store, features=SIGNAL_FEATURES, n_bins=HISTOGRAM_BINS):
+    """
+    Bins every track's plotted features and records the library-wide histograms and quantiles.
+    :param store: a LibraryStore
+    :param features: the feature columns to bin, those missing from the library are skipped
+    :param n_bins: histogram bins per feature, at most 255
+    :return store: the same LibraryStore with bins and distributions set
+    """
+    features = [name for name in features if name in store.feature_columns]
+    values = store.feature_frame(features).to_numpy(dtype=np.float64)
+    present = ~np.isnan(values)
+    low, high = np.nanmin(values, axis=0), np.nanmax(values, axis=0)
+    # equal width bins over each feature's library range, widened around constant features
+    high = np.where(high > low, high, low + 1)
+    edges = low[:, None] + (high - low)[:, None] * np.linspace(0, 1, n_bins + 1)[None, :]
+    bins = np.floor((np.nan_to_num(values) - low) / (high - low) * n_bins).clip(0, n_bins - 1)
+    # missing values get the extra bin n_bins, which histograms drop
+    bins = np.where(present, bins, n_bins).astype(np.uint8)
+    store.bins = bins
+    store.distributions = {
+        'features': features,
+        'edges': edges,
+        'counts': np.stack([np.bincount(bins[:, i], minlength=n_bins + 1)[:n_bins] for i in range(len(features))]),
+        'quantile_levels': np.asarray(QUANTILES),
+        'quantiles': np.nanquantile(values, QUANTILES, axis=0),
+        'mean': np.nanmean(values, axis=0),
+    }
+    return store
+
+
+def build_library(source, out_path, pipeline_path=PIPELINE_PATH, n_partitions=0, quantized_dtype=None):
+    """
+    Parses the recommendation library csv once and writes it in the columnar layout.
+    :param source: url or path of the recommendation library csv
+    :param out_path: destination library directory
+    :param pipeline_path: path to the pickled pipeline used to pre-scale the library, None skips it
+    :param n_partitions: number of partitions, None uses the square root of the library size, 0 (the
+        default) keeps the library unpartitioned and exact (partitioning needs a pipeline)
+    :param quantized_dtype: optional 'int8' or 'float16' to also write a quantized library (needs a pipeline)
+    :return store: the LibraryStore that was written
+    """
+    store = LibraryStore.from_frame(pd.read_csv(source))
+    if pipeline_path is not None:
+        prescale(store, read_pipeline(pipeline_path).steps[0][1])
+        if n_partitions != 0:
+            store = partition(store, n_partitions)
+        if quantized_dtype is not None:
+            add_quantized(store, quantized_dtype)
+    add_distributions(store)
+    write_store(store, out_path)
+    return store
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert the recommendation library csv to the columnar layout.")
+    parser.add_argument('--source', default=LIBRARY_URL)
+    parser.add_argument('--out', default='library')
+    parser.add_argument('--pipeline', default=PIPELINE_PATH)
+    parser.add_argument('--partitions', type=int, nargs='?', const=None, default=0,
+                        help="partition the library for approximate search, alone uses sqrt(n) partitions")
+    parser.add_argument('--quantize', choices=QUANTIZED_DTYPES, default=None)
+    args = parser.parse_args()
+    built = build_library(args.source, args.out, args.pipeline, args.partitions, args.quantize)
+    print(f"Wrote {len(built)} tracks ({len(built.feature_columns)} numeric columns) to {args.out}")
@@ -0,0 +1,213 @@
+import os
+import pickle
+import threading
+import time
+import numpy as np
+import pandas as pd
+import requests
+import ann_index
+from library_store import LibraryStore, MANIFEST_NAME, is_store, library_fingerprint
+from recommend_engine import QuantizedEngine, TopKEngine
+
+LIBRARY_URL = "https://myawsbucketdsi221.s3.us-east-2.amazonaws.com/rec_library_full.csv"
+# directory written by library_build.py, preferred over the csv when it exists
+LIBRARY_DIR = "library"
+LIBRARY_PATH = os.getenv("SONGSUGGEST_LIBRARY", LIBRARY_DIR if is_store(LIBRARY_DIR) else LIBRARY_URL)
+PIPELINE_PATH = os.getenv("SONGSUGGEST_PIPELINE", "extended_library.pkl")
+# seconds between checks of the library ETag and pipeline file for a newer version
+CHECK_INTERVAL = 300
+
+
+######################################################################################################
+# Library and Pipeline Loading
+######################################################################################################
+
+def read_library(path=LIBRARY_PATH):
+    """
+    Opens the recommendation library. Columnar library directories are memory mapped, anything else is
+    parsed as a csv from a url or local path.
+    :param path: a library directory, or url or path of the recommendation library csv
+    :return store: a library_store.LibraryStore of library tracks and their audio features
+    """
+    if is_store(path):
+        return LibraryStore.open(path)
+    return LibraryStore.from_frame(pd.read_csv(path))
+
+
+def read_pipeline(path=PIPELINE_PATH):
+    """
+    Unpickles the fitted pipeline whose first step is the StandardScaler.
+    :param path: path to the pickled pipeline
+    :return pipeline: a fitted sklearn Pipeline
+    """
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def get_model_columns(scaler, fallback_columns):
+    """
+    Returns the numeric columns the scaler was fitted on, in the fitted order. Scaling columns in any other
+    order silently applies one feature's mean and scale to another.
+    :param scaler: the StandardScaler from the fitted pipeline
+    :param fallback_columns: numeric column names used when the scaler carries no feature names
+    :return num_columns: a list of column names
+    """
+    # scalers fitted on a dataframe remember the column names and their order
+    if hasattr(scaler, 'feature_names_in_'):
+        return list(scaler.feature_names_in_)
+    # otherwise fall back to the provided numeric columns
+    return list(fallback_columns)
+
+
+def source_version(path):
+    """
+    Identifies the current version of a library or pipeline source without downloading it. Urls use the
+    ETag (or Last-Modified) header, local files use their modification time and size.
+    :param path: url or local path
+    :return version: a string identifying the version, or None when it cannot be determined
+    """
+    # a library directory changes when library_build.py rewrites its manifest
+    if is_store(path):
+        path = os.path.join(path, MANIFEST_NAME)
+    if path.startswith('http://') or path.startswith('https://'):
+        try:
+            response = requests.head(path, timeout=5)
+            response.raise_for_status()
+        except requests.RequestException:
+            return None
+        return response.headers.get('ETag') or response.headers.get('Last-Modified')
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+
+class LoadedLibrary:
+    """
+    Everything song_recommendations needs from the static library, loaded and prepared once.
+    :param store: a library_store.LibraryStore of the recommendation library
+    :param pipeline: the fitted sklearn Pipeline
+    :param version: a tuple of the library, pipeline and index versions this was loaded from
+    :param index_path: path of an optional ann_index.IVFIndex built over this library, ignored when the
+        library was built with partitions
+    """
+
+    def __init__(self, store, pipeline, version=None, index_path=ann_index.DEFAULT_INDEX_PATH):
+        self.store = store
+        self.pipeline = pipeline
+        self.version = version
+        self._fingerprint = None
+        self.scaler = pipeline.steps[0][1]
+        self.num_columns = get_model_columns(self.scaler, store.feature_columns)
+        if store.scaled is not None:
+            # the library was scaled at build time, only serve it if the same scaler did the scaling
+            store.check_scaled(self.scaler, self.num_columns)
+            if store.quantized is not None:
+                # scan the small quantized copy and only page in the exact rows of the best candidates
+                self.engine = QuantizedEngine(store.quantized, store.quant_scale, store.quant_offset,
+                                              exact=store.scaled)
+            else:
+                self.engine = TopKEngine(store.scaled, normalized=True)
+        else:
+            # a csv library is scaled and normalized once per load instead of once per request
+            self.engine = TopKEngine(self.scaler.transform(store.feature_frame(self.num_columns)))
+        if store.partition_offsets is not None:
+            # a partitioned library is its own IVF index, its cells are already contiguous rows of scaled,
+            # a quantized library scores the probed cells on the quantized copy and re-ranks from scaled
+            quantized = self.engine if isinstance(self.engine, QuantizedEngine) else None
+            self.index = ann_index.IVFIndex(store.partition_centroids, store.partition_offsets,
+                                            np.arange(len(store)), store.scaled, quantized=quantized)
+        else:
+            # an index built over a different library cannot be trusted, serve exactly instead
+            index = ann_index.load_index(index_path)
+            self.index = index if index is not None and self.accepts(index) else None
+
+    def __len__(self):
+        return len(self.store)
+
+    def accepts(self, index):
+        """
+        :param index: an ann_index.IVFIndex
+        :return: True when the index was built over exactly these library rows
+        """
+        if index is getattr(self, 'index', None):
+            return True
+        if self._fingerprint is None:
+            self._fingerprint = library_fingerprint(self.store)
+        return len(index) == len(self.store) and index.fingerprint == self._fingerprint
+
+
+class LibraryCache:
+    """
+    Process-wide holder of the loaded library. The first call to get loads it, later calls return the warm
+    copy. Every check_interval seconds the source versions are compared and a changed ETag or pipeline
+    file triggers a reload; invalidate forces one on the next get.
+    :param library_path: a library directory, or url or path of the recommendation library csv
+    :param pipeline_path: path to the pickled pipeline
+    :param index_path: path of an optional ann_index.IVFIndex, rebuilding it also triggers a reload
+    :param check_interval: seconds between version checks, None never checks
+    """
+
+    def __init__(self, library_path=LIBRARY_PATH, pipeline_path=PIPELINE_PATH,
+                 index_path=ann_index.DEFAULT_INDEX_PATH, check_interval=CHECK_INTERVAL):
+        self.library_path = library_path
+        self.pipeline_path = pipeline_path
+        self.index_path = index_path
+        self.check_interval = check_interval
+        self._loaded = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def version(self):
+        """
+        :return version: a tuple of the current library, pipeline and index versions, the index version is
+            None while no index has been built
+        """
+        return source_version(self.library_path), source_version(self.pipeline_path), source_version(self.index_path)
+
+    def get(self):
+        """
+        Returns the warm library, loading or reloading it first when needed.
+        :return library: a LoadedLibrary
+        """
+        with self._lock:
+            if self._loaded is None:
+                self._load(self.version())
+            elif self.check_interval is not None and time.monotonic() - self._checked_at > self.check_interval:
+                version = self.version()
+                self._checked_at = time.monotonic()
+                # an unreachable source keeps serving the warm copy, a missing index is not an error
+                if None not in version[:2] and version != self._loaded.version:
+                    self._load(version)
+            return self._loaded
+
+    def invalidate(self):
+        """
+        Drops the warm library so the next get reloads it.
+        """
+        with self._lock:
+            self._loaded = None
+
+    def _load(self, version):
+        self._loaded = LoadedLibrary(read_library(self.library_path), read_pipeline(self.pipeline_path), version,
+                                     self.index_path)
+        self._checked_at = time.monotonic()
+
+
+_default_cache = LibraryCache()
+
+
+def get_library():
+    """
+    Returns the process-wide warm library shared by every entry point.
+    :return library: a LoadedLibrary
+    """
+    return _default_cache.get()
+
+
+def invalidate():
+    """
+    Forces the process-wide library to reload on its next use.
+    """
+    _default_cache.invalidate()
@@ -0,0 +1,367 @@
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+
+MANIFEST_NAME = "manifest.json"
+FEATURES_NAME = "features.npy"
+SCALED_NAME = "scaled.npy"
+SOURCE_ROWS_NAME = "source_rows.npy"
+PARTITION_CENTROIDS_NAME = "partition_centroids.npy"
+PARTITION_OFFSETS_NAME = "partition_offsets.npy"
+QUANTIZED_NAME = "quantized.npy"
+BINS_NAME = "bins.npy"
+METADATA_DIR = "metadata"
+FORMAT_VERSION = 2
+
+
+######################################################################################################
+# Columnar Library Store
+######################################################################################################
+# The recommendation library on disk is a directory:
+#   manifest.json        column order, dtypes and row count
+#   features.npy         every numeric column as one float64 (n_tracks x n_numeric) block
+#   metadata/<col>.npy   every string column (track_name, artist, album, ...) as its own UTF-8 byte blob,
+#                        metadata/<col>.offsets.npy holds where each row's bytes start and end
+#   scaled.npy           optional, the model columns after the fitted scaler, L2-normalized, as float32
+#   partition_*.npy      optional, cluster centroids and row offsets when rows are stored cluster by cluster
+#   source_rows.npy      optional, each row's position in the original csv when rows were reordered
+#   quantized.npy        optional, scaled as int8 or float16, its per-feature scale and offset are in the manifest
+#   bins.npy             optional, each track's histogram bin per plotted feature, the bin edges, library-wide
+#                        counts and quantiles are in the manifest
+# All arrays are opened with mmap, so opening a library costs a few page faults instead of a csv parse,
+# and only the rows actually recommended are ever read from the string columns.
+
+def scaler_fingerprint(scaler, columns):
+    """
+    Hashes everything a StandardScaler's output depends on, so a persisted scaled matrix can be matched
+    against the scaler that is about to transform queries.
+    :param scaler: a fitted StandardScaler
+    :param columns: the model columns, in the order they are scaled
+    :return fingerprint: a hex digest
+    """
+    digest = hashlib.sha256(json.dumps(list(columns)).encode())
+    for name in ('mean_', 'scale_'):
+        value = getattr(scaler, name, None)
+        digest.update(b'none' if value is None else np.asarray(value, dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+
+class StringColumn:
+    """
+    A column of strings stored as one UTF-8 byte blob plus row offsets, so it costs the bytes of its values
+    instead of rows x longest value, and both arrays can be memory mapped. Indexing decodes only the
+    requested rows.
+    :param data: a uint8 np array of the concatenated UTF-8 encoded values
+    :param offsets: an int64 np array (n_rows + 1) where row r owns data[offsets[r]:offsets[r+1]]
+    """
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    @classmethod
+    def from_values(cls, values):
+        """
+        :param values: an iterable of strings
+        :return column: an in-memory StringColumn
+        """
+        encoded = [value.encode('utf-8') for value in values]
+        lengths = np.fromiter((len(value) for value in encoded), dtype=np.int64, count=len(encoded))
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        return cls(np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets)
+
+    def __len__(self):
+        return self.offsets.shape[0] - 1
+
+    def __getitem__(self, rows):
+        """
+        :param rows: a row position or an array-like of row positions of any shape
+        :return values: the string, or an object np array of strings shaped like rows
+        """
+        if np.isscalar(rows):
+            return self[np.asarray([rows])][0]
+        rows = np.asarray(rows, dtype=np.int64)
+        starts, ends = self.offsets[rows.ravel()], self.offsets[rows.ravel() + 1]
+        # reading most of the column at once beats one small slice of the mmap per row
+        data = self.data.tobytes() if rows.size > len(self) // 8 else self.data
+        values = np.empty(rows.size, dtype=object)
+        values[:] = [bytes(data[start:end]).decode('utf-8') for start, end in zip(starts, ends)]
+        return values.reshape(rows.shape)
+
+    def __array__(self, dtype=None, copy=None):
+        return self[np.arange(len(self))]
+
+
+def library_fingerprint(store):
+    """
+    Hashes the identity and order of a library's rows, so an index of row positions built over one library
+    is never served against another that merely has the same number of rows.
+    :param store: a LibraryStore
+    :return fingerprint: a hex digest
+    """
+    digest = hashlib.sha256(str(len(store)).encode())
+    if 'id' in store.metadata:
+        # track ids identify the rows, hashed in row order
+        digest.update('\n'.join(store.metadata['id'][np.arange(len(store))]).encode('utf-8'))
+    else:
+        digest.update(np.ascontiguousarray(store.features).tobytes())
+    return digest.hexdigest()
+
+
+def is_store(path):
+    """
+    :param path: a url, file or directory path
+    :return: True when path is a directory written by write_store
+    """
+    return os.path.isfile(os.path.join(path, MANIFEST_NAME))
+
+
+class LibraryStore:
+    """
+    Column oriented view of the recommendation library.
+    :param columns: all column names in their original order
+    :param feature_columns: the numeric column names, in the order of the features block
+    :param features: a 2D np array (n_tracks x n_numeric) of the numeric columns
+    :param metadata: a dict of string column name to StringColumn
+    :param dtypes: a dict of numeric column name to its original dtype string
+    :param scaled: an optional float32 np array (n_tracks x n_model_columns) of scaled, normalized rows
+    :param scaled_columns: the model columns scaled holds, in order
+    :param fingerprint: the scaler_fingerprint of the scaler that produced scaled
+    :param source_rows: an optional np array of each row's position in the original csv
+    :param partition_centroids: an optional float32 np array (n_partitions x n_model_columns) of unit centroids
+    :param partition_offsets: an optional int64 np array where partition p owns rows offsets[p]:offsets[p+1]
+    :param quantized: an optional int8 or float16 np array of scaled, see recommend_engine.quantize
+    :param quant_scale: a float32 np array of the per-feature scales of quantized
+    :param quant_offset: a float32 np array of the per-feature offsets of quantized
+    :param bins: an optional uint8 np array (n_tracks x n_features) of histogram bin indices
+    :param distributions: a dict of the features, edges, counts, quantile_levels and quantiles that bins
+        belongs to, see library_build.add_distributions
+    """
+
+    def __init__(self, columns, feature_columns, features, metadata, dtypes=None,
+                 scaled=None, scaled_columns=None, fingerprint=None,
+                 source_rows=None, partition_centroids=None, partition_offsets=None,
+                 quantized=None, quant_scale=None, quant_offset=None, bins=None, distributions=None):
+        self.columns = list(columns)
+        self.feature_columns = list(feature_columns)
+        self.features = features
+        self.metadata = metadata
+        self.dtypes = dtypes or {}
+        self.scaled = scaled
+        self.scaled_columns = list(scaled_columns) if scaled_columns is not None else None
+        self.fingerprint = fingerprint
+        self.source_rows = source_rows
+        self.partition_centroids = partition_centroids
+        self.partition_offsets = partition_offsets
+        self.quantized = quantized
+        self.quant_scale = quant_scale
+        self.quant_offset = quant_offset
+        self.bins = bins
+        self.distributions = distributions
+        self._source_positions = None
+        self._feature_positions = {name: i for i, name in enumerate(self.feature_columns)}
+
+    def __len__(self):
+        return self.features.shape[0]
+
+    @classmethod
+    def from_frame(cls, df):
+        """
+        Splits an in-memory library dataframe into the columnar layout.
+        :param df: a pandas DataFrame of the recommendation library
+        :return store: a LibraryStore holding in-memory arrays
+        """
+        feature_columns = list(df.select_dtypes(np.number).columns)
+        features = np.ascontiguousarray(df[feature_columns].to_numpy(dtype=np.float64))
+        # strings are stored as UTF-8 bytes so they can be memory mapped, missing values become ''
+        metadata = {name: StringColumn.from_values(df[name].fillna('').astype(str))
+                    for name in df.columns if name not in feature_columns}
+        dtypes = {name: str(df[name].dtype) for name in feature_columns}
+        return cls(df.columns, feature_columns, features, metadata, dtypes)
+
+    @classmethod
+    def open(cls, path):
+        """
+        Opens a library directory without reading its arrays into memory.
+        :param path: a directory written by write_store
+        :return store: a LibraryStore backed by memory mapped arrays
+        """
+        with open(os.path.join(path, MANIFEST_NAME)) as f:
+            manifest = json.load(f)
+        if manifest['format_version'] != FORMAT_VERSION:
+            raise ValueError(f"Unsupported library format version: {manifest['format_version']}. "
+                             f"Rebuild the library with library_build.py.")
+        features = np.load(os.path.join(path, FEATURES_NAME), mmap_mode='r')
+        metadata = {name: StringColumn(np.load(os.path.join(path, METADATA_DIR, f"{name}.npy"), mmap_mode='r'),
+                                       np.load(os.path.join(path, METADATA_DIR, f"{name}.offsets.npy"), mmap_mode='r'))
+                    for name in manifest['metadata_columns']}
+        scaled = None
+        if manifest.get('scaled_columns') is not None:
+            scaled = np.load(os.path.join(path, SCALED_NAME), mmap_mode='r')
+        source_rows = partition_centroids = partition_offsets = None
+        if manifest.get('partitions'):
+            source_rows = np.load(os.path.join(path, SOURCE_ROWS_NAME))
+            partition_centroids = np.load(os.path.join(path, PARTITION_CENTROIDS_NAME))
+            partition_offsets = np.load(os.path.join(path, PARTITION_OFFSETS_NAME))
+        quantized = quant_scale = quant_offset = None
+        if manifest.get('quantization'):
+            quantized = np.load(os.path.join(path, QUANTIZED_NAME), mmap_mode='r')
+            quant_scale = np.asarray(manifest['quantization']['scale'], dtype=np.float32)
+            quant_offset = np.asarray(manifest['quantization']['offset'], dtype=np.float32)
+        bins = distributions = None
+        if manifest.get('distributions'):
+            bins = np.load(os.path.join(path, BINS_NAME), mmap_mode='r')
+            distributions = {name: value if name == 'features' else np.asarray(value)
+                             for name, value in manifest['distributions'].items()}
+        return cls(manifest['columns'], manifest['feature_columns'], features, metadata, manifest['dtypes'],
+                   scaled, manifest.get('scaled_columns'), manifest.get('scaler_fingerprint'),
+                   source_rows, partition_centroids, partition_offsets, quantized, quant_scale, quant_offset,
+                   bins, distributions)
+
+    def reorder(self, order):
+        """
+        Returns a copy of the library with its rows in a new order, remembering where each row came from.
+        :param order: a np array permutation of row positions
+        :return store: a new in-memory LibraryStore
+        """
+        source_rows = np.arange(len(self)) if self.source_rows is None else np.asarray(self.source_rows)
+        return LibraryStore(
+            self.columns, self.feature_columns, np.ascontiguousarray(self.features[order]),
+            {name: StringColumn.from_values(values[order]) for name, values in self.metadata.items()}, self.dtypes,
+            None if self.scaled is None else np.ascontiguousarray(self.scaled[order]),
+            self.scaled_columns, self.fingerprint, source_rows[order]
+        )
+
+    def feature_frame(self, columns):
+        """
+        Returns the requested numeric columns for every track.
+        :param columns: a list of numeric column names
+        :return df: a pandas DataFrame of the requested columns
+        """
+        positions = [self._feature_positions[name] for name in columns]
+        return pd.DataFrame(self.features[:, positions], columns=columns)
+
+    def check_scaled(self, scaler, columns):
+        """
+        Refuses to serve a persisted scaled matrix that was produced by a different scaler or column order.
+        :param scaler: the fitted StandardScaler that will transform queries
+        :param columns: the model columns, in the order they are scaled
+        :raise ValueError: when the scaled matrix does not match the scaler
+        """
+        if self.scaled_columns != list(columns) or self.fingerprint != scaler_fingerprint(scaler, columns):
+            raise ValueError("The library's pre-scaled matrix was built with a different scaler than the loaded "
+                             "pipeline. Rebuild the library with library_build.py --pipeline.")
+
+    def take(self, rows):
+        """
+        Materializes only the requested tracks as a dataframe shaped like the original csv.
+        :param rows: a sequence of library row positions
+        :return df: a pandas DataFrame indexed by original csv row position with every library column
+        """
+        rows = np.asarray(rows)
+        data = {}
+        for name in self.columns:
+            if name in self._feature_positions:
+                values = self.features[rows, self._feature_positions[name]]
+                data[name] = values.astype(self.dtypes.get(name, 'float64'))
+            else:
+                data[name] = self.metadata[name][rows]
+        index = rows if self.source_rows is None else self.source_rows[rows]
+        return pd.DataFrame(data, index=index, columns=self.columns)
+
+    def positions(self, labels):
+        """
+        Maps the index labels of a frame returned by take back to library row positions.
+        :param labels: a sequence of original csv row positions
+        :return rows: a np array of library row positions
+        """
+        labels = np.asarray(labels, dtype=np.int64)
+        if self.source_rows is None:
+            return labels
+        if self._source_positions is None:
+            # invert the build's reordering once
+            self._source_positions = np.empty(len(self), dtype=np.int64)
+            self._source_positions[self.source_rows] = np.arange(len(self))
+        return self._source_positions[labels]
+
+    def histogram(self, rows):
+        """
+        Counts the selected tracks per precomputed histogram bin, without reading their feature values.
+        :param rows: a sequence of library row positions
+        :return counts: an int64 np array (n_features x n_bins)
+        """
+        if self.bins is None:
+            raise ValueError("The library has no precomputed distributions. Rebuild it with library_build.py.")
+        n_features, n_bins = self.bins.shape[1], len(self.distributions['edges'][0]) - 1
+        # one bincount over every feature, shifting each feature's bins into its own range
+        # (bin n_bins marks a missing value and lands in a dropped slot)
+        shifted = self.bins[np.asarray(rows)].astype(np.int64) + np.arange(n_features) * (n_bins + 1)
+        counts = np.bincount(shifted.ravel(), minlength=n_features * (n_bins + 1))
+        return counts.reshape(n_features, n_bins + 1)[:, :n_bins]
+
+
+def write_store(store, path):
+    """
+    Writes a LibraryStore as a library directory. The files are written to a sibling directory that is
+    renamed over path once complete, so processes that already memory mapped the old library keep reading
+    the old files instead of the new bytes, and a new open never mixes files from two builds.
+    :param store: a LibraryStore
+    :param path: destination directory, replaced if it exists
+    """
+    path = os.path.normpath(path)
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    _write_files(store, tmp_path)
+    if os.path.exists(path):
+        # the old files are only unlinked, mapped readers hold on to them until they reload
+        old_path = f"{path}.old-{os.getpid()}"
+        os.rename(path, old_path)
+        os.rename(tmp_path, path)
+        shutil.rmtree(old_path)
+    else:
+        os.rename(tmp_path, path)
+
+
+def _write_files(store, path):
+    os.makedirs(os.path.join(path, METADATA_DIR), exist_ok=True)
+    np.save(os.path.join(path, FEATURES_NAME), np.ascontiguousarray(store.features))
+    for name, values in store.metadata.items():
+        np.save(os.path.join(path, METADATA_DIR, f"{name}.npy"), np.asarray(values.data, dtype=np.uint8))
+        np.save(os.path.join(path, METADATA_DIR, f"{name}.offsets.npy"), np.asarray(values.offsets, dtype=np.int64))
+    if store.scaled is not None:
+        np.save(os.path.join(path, SCALED_NAME), np.ascontiguousarray(store.scaled, dtype=np.float32))
+    partitioned = store.partition_offsets is not None
+    if partitioned:
+        np.save(os.path.join(path, SOURCE_ROWS_NAME), store.source_rows)
+        np.save(os.path.join(path, PARTITION_CENTROIDS_NAME), store.partition_centroids)
+        np.save(os.path.join(path, PARTITION_OFFSETS_NAME), store.partition_offsets)
+    if store.bins is not None:
+        np.save(os.path.join(path, BINS_NAME), np.ascontiguousarray(store.bins))
+    quantization = None
+    if store.quantized is not None:
+        np.save(os.path.join(path, QUANTIZED_NAME), np.ascontiguousarray(store.quantized))
+        quantization = {'dtype': str(store.quantized.dtype), 'scale': np.asarray(store.quant_scale).tolist(),
+                        'offset': np.asarray(store.quant_offset).tolist()}
+    manifest = {
+        'format_version': FORMAT_VERSION,
+        'n_rows': len(store),
+        'columns': store.columns,
+        'feature_columns': store.feature_columns,
+        'metadata_columns': list(store.metadata),
+        'dtypes': store.dtypes,
+        'scaled_columns': store.scaled_columns if store.scaled is not None else None,
+        'scaler_fingerprint': store.fingerprint if store.scaled is not None else None,
+        'partitions': len(store.partition_offsets) - 1 if partitioned else None,
+        'quantization': quantization,
+        'distributions': None if store.bins is None else {
+            name: value if name == 'features' else np.asarray(value).tolist()
+            for name, value in store.distributions.items()
+        },
+    }
+    # the manifest is written last so a half written directory is never recognized as a library
+    with open(os.path.join(path, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2)
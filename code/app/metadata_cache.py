@@ -0,0 +1,164 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+CACHE_PATH = os.getenv("SONGSUGGEST_CACHE_PATH", "metadata_cache.sqlite")
+# seconds an entry stays fresh, audio features are effectively immutable, genres drift slowly
+DAY = 24 * 60 * 60
+TTLS = {
+    'audio_features': 180 * DAY,
+    'artist_genres': 30 * DAY,
+    # playlists are checked against their snapshot_id on every sync, the TTL only bounds stale storage
+    'playlist_tracks': 30 * DAY,
+}
+MAX_ENTRIES = 500000
+# sqlite limits the number of parameters in one statement
+_SQL_BATCH = 500
+
+
+######################################################################################################
+# Persistent Metadata Cache
+######################################################################################################
+# A read-through cache for Spotify metadata keyed by track id or artist uri. Entries live in a single
+# sqlite table so they survive restarts and are shared by every process on the host. Each namespace has
+# its own TTL; once the table grows past max_entries the least recently read entries are evicted.
+
+class MetadataCache:
+    """
+    Durable key/value cache of JSON-serializable Spotify metadata.
+    :param path: sqlite database file, ':memory:' keeps the cache in process
+    :param ttls: a dict of namespace to seconds an entry stays fresh
+    :param max_entries: the largest number of entries kept across all namespaces
+    """
+
+    def __init__(self, path=CACHE_PATH, ttls=None, max_entries=MAX_ENTRIES):
+        self.path = path
+        self.ttls = dict(TTLS, **(ttls or {}))
+        self.max_entries = max_entries
+        self.hits = {}
+        self.misses = {}
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT, "
+                "stored_at REAL NOT NULL, accessed_at REAL NOT NULL, "
+                "PRIMARY KEY (namespace, key))"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed_at)")
+
+    def get_many(self, namespace, keys):
+        """
+        Reads the fresh entries for a list of keys.
+        :param namespace: one of the TTLS namespaces, e.g. 'audio_features'
+        :param keys: an iterable of track ids or artist uris
+        :return entries: a dict of key to cached value for every key that was a fresh hit
+        """
+        keys = list(dict.fromkeys(keys))
+        now = time.time()
+        oldest = now - self.ttls.get(namespace, 0)
+        entries = {}
+        with self._lock, self._connection:
+            for start in range(0, len(keys), _SQL_BATCH):
+                batch = keys[start:start + _SQL_BATCH]
+                rows = self._connection.execute(
+                    f"SELECT key, value FROM entries WHERE namespace = ? AND stored_at >= ? "
+                    f"AND key IN ({','.join('?' * len(batch))})", [namespace, oldest] + batch
+                ).fetchall()
+                entries.update((key, json.loads(value)) for key, value in rows)
+            # mark hits as recently used so eviction keeps popular tracks
+            self._connection.executemany(
+                "UPDATE entries SET accessed_at = ? WHERE namespace = ? AND key = ?",
+                [(now, namespace, key) for key in entries]
+            )
+            self.hits[namespace] = self.hits.get(namespace, 0) + len(entries)
+            self.misses[namespace] = self.misses.get(namespace, 0) + len(keys) - len(entries)
+        return entries
+
+    def put_many(self, namespace, entries):
+        """
+        Writes or refreshes entries, then evicts the least recently read ones past max_entries.
+        :param namespace: one of the TTLS namespaces, e.g. 'audio_features'
+        :param entries: a dict of key to JSON-serializable value, None values are cached as known misses
+        """
+        if not entries:
+            return
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO entries (namespace, key, value, stored_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                [(namespace, key, json.dumps(value), now, now) for key, value in entries.items()]
+            )
+            count = self._connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+            if count > self.max_entries:
+                self._connection.execute(
+                    "DELETE FROM entries WHERE rowid IN (SELECT rowid FROM entries ORDER BY accessed_at LIMIT ?)",
+                    (count - self.max_entries,)
+                )
+
+    def read_through(self, namespace, keys, fetch_many):
+        """
+        Returns cached entries and fetches only the keys that missed, caching what was fetched.
+        :param namespace: one of the TTLS namespaces, e.g. 'audio_features'
+        :param keys: an iterable of track ids or artist uris, duplicates allowed
+        :param fetch_many: a function taking a list of missing keys and returning a dict of key to value
+        :return entries: a dict of key to value for every key that was cached or fetched, in first-seen key order
+        """
+        keys = [key for key in dict.fromkeys(keys) if key is not None and key == key]
+        entries = self.get_many(namespace, keys)
+        missing = [key for key in keys if key not in entries]
+        if missing:
+            fetched = fetch_many(missing)
+            self.put_many(namespace, fetched)
+            entries.update(fetched)
+        # hits come back first, callers get the order they asked in
+        return {key: entries[key] for key in keys if key in entries}
+
+    def stats(self):
+        """
+        :return stats: a dict of namespace to its hit and miss counts since this cache was opened
+        """
+        namespaces = set(self.hits) | set(self.misses)
+        return {name: {'hits': self.hits.get(name, 0), 'misses': self.misses.get(name, 0)} for name in namespaces}
+
+    def clear(self, namespace=None):
+        """
+        Deletes every entry, or every entry of one namespace.
+        :param namespace: optional namespace to clear
+        """
+        with self._lock, self._connection:
+            if namespace is None:
+                self._connection.execute("DELETE FROM entries")
+            else:
+                self._connection.execute("DELETE FROM entries WHERE namespace = ?", (namespace,))
+
+
+_default_cache = None
+_default_lock = threading.Lock()
+
+
+def get_default_cache():
+    """
+    Opens the process-wide cache at CACHE_PATH on first use.
+    :return cache: a MetadataCache
+    """
+    global _default_cache
+    with _default_lock:
+        if _default_cache is None:
+            _default_cache = MetadataCache()
+        return _default_cache
+
+
+def set_default_cache(cache):
+    """
+    Replaces the process-wide cache, e.g. with MetadataCache(':memory:') so a stub backend never writes
+    its answers into the shared cache file.
+    :param cache: a MetadataCache
+    """
+    global _default_cache
+    with _default_lock:
+        _default_cache = cache
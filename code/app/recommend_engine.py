@@ -0,0 +1,328 @@
+import numpy as np
+
+
+######################################################################################################
+# Top-K Cosine Engine
+######################################################################################################
+# song_recommendations used to compute a full cosine distance row with cdist and then argsort the whole
+# row just to keep the first 10 songs. The engine below keeps the library L2-normalized in float32 once
+# so a query is a single matrix-vector product followed by a partial selection of the k best rows, and a
+# batch of queries is a blocked matrix-matrix product with a running top-k per query.
+
+# library rows scored per block in query_batch, bounds memory to query_block_size x BLOCK_SIZE scores
+BLOCK_SIZE = 65536
+
+
+def normalize_rows(matrix):
+    """
+    L2-normalizes each row of a matrix and returns a C-contiguous float32 copy. Rows with a zero norm
+    are left as zeros so they score 0 (cosine distance 1) instead of producing NaNs.
+    :param matrix: a 2D array-like of scaled audio feature rows
+    :return normed: a float32 np array where every non-zero row has unit length
+    """
+    # cast once to float32 so every later product runs on the smaller dtype
+    matrix = np.asarray(matrix, dtype=np.float32)
+    # compute the length of every row
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    # avoid dividing by zero for empty rows
+    norms[norms == 0] = 1
+    # divide each row by its length
+    return np.ascontiguousarray(matrix / norms)
+
+
+def top_k(scores, k):
+    """
+    Selects the positions of the k largest scores using a partial selection, then orders only those k.
+    Ties are broken by position so the output is deterministic.
+    :param scores: a 1D np array of similarity scores
+    :param k: number of positions to keep
+    :return index: a np array of at most k positions ordered from most to least similar
+    """
+    # never ask for more rows than exist
+    k = min(k, scores.shape[0])
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    # argpartition places the k largest scores in the last k slots in O(N)
+    if k < scores.shape[0]:
+        candidates = np.argpartition(scores, -k)[-k:]
+    else:
+        candidates = np.arange(scores.shape[0])
+    # order the k candidates by descending score, then ascending position for ties
+    order = np.lexsort((candidates, -scores[candidates]))
+    return candidates[order]
+
+
+def top_k_rows(scores, ids, k):
+    """
+    Row-wise version of top_k for a 2D block of scores with the library positions they belong to.
+    :param scores: a 2D np array (n_queries x n_candidates) of similarity scores
+    :param ids: a 2D np array of library positions shaped like scores
+    :param k: number of candidates to keep per row
+    :return scores: a 2D np array (n_queries x k) of the best scores, best first
+    :return ids: a 2D np array (n_queries x k) of the matching library positions
+    """
+    k = min(k, scores.shape[1])
+    if k < scores.shape[1]:
+        # partial selection of the k best candidates of every row
+        keep = np.argpartition(scores, -k, axis=1)[:, -k:]
+        scores = np.take_along_axis(scores, keep, axis=1)
+        ids = np.take_along_axis(ids, keep, axis=1)
+    # order each row by descending score, then ascending position for ties
+    order = np.lexsort((ids, -scores), axis=-1)
+    return np.take_along_axis(scores, order, axis=1), np.take_along_axis(ids, order, axis=1)
+
+
+def allocate_quotas(sizes, k):
+    """
+    Splits k recommendation slots between centroids in proportion to how many seeds each one holds, using
+    the largest remainder method. Every centroid gets at least one slot while slots last.
+    :param sizes: a sequence of seed counts per centroid
+    :param k: number of slots to split
+    :return quotas: a np array of slot counts per centroid that sums to k
+    """
+    sizes = np.asarray(sizes, dtype=np.float64)
+    # one guaranteed slot each, as far as k allows, biggest clusters first
+    quotas = np.zeros(len(sizes), dtype=np.int64)
+    quotas[np.argsort(-sizes, kind='stable')[:min(k, len(sizes))]] = 1
+    remaining = k - quotas.sum()
+    if remaining > 0:
+        share = sizes / sizes.sum() * remaining
+        quotas += np.floor(share).astype(np.int64)
+        # hand the leftover slots to the largest fractional parts
+        leftover = remaining - np.floor(share).sum().astype(np.int64)
+        quotas[np.argsort(-(share - np.floor(share)), kind='stable')[:leftover]] += 1
+    return quotas
+
+
+def merge_with_quota(index, distances, quotas, k):
+    """
+    Merges per-centroid top-k lists into one list of k unique rows. Each centroid contributes up to its quota
+    of rows not already taken, then any slots left over are filled with the nearest remaining candidates.
+    :param index: a 2D np array (n_centroids x n_candidates) of library positions, nearest first per row
+    :param distances: a 2D np array of the matching cosine distances
+    :param quotas: a sequence of slots per centroid, e.g. from allocate_quotas
+    :param k: number of rows to return
+    :return index: a np array of at most k unique library positions ordered by distance
+    :return distances: a np array of the matching cosine distances
+    """
+    chosen = {}
+    for row, quota in enumerate(quotas):
+        taken = 0
+        for position, distance in zip(index[row], distances[row]):
+            if taken == quota:
+                break
+            if position not in chosen:
+                chosen[position] = distance
+                taken += 1
+    # fill slots left by duplicates shared between centroids from the nearest unused candidates
+    if len(chosen) < k:
+        for flat in np.argsort(distances, axis=None, kind='stable'):
+            position = index.flat[flat]
+            if position not in chosen:
+                chosen[position] = distances.flat[flat]
+                if len(chosen) == k:
+                    break
+    positions = np.fromiter(chosen.keys(), dtype=np.int64, count=len(chosen))
+    merged = np.fromiter(chosen.values(), dtype=np.float64, count=len(chosen))
+    order = np.lexsort((positions, merged))
+    return positions[order], merged[order]
+
+
+class TopKEngine:
+    """
+    Exact cosine top-k search over a static library matrix.
+    :param matrix: a 2D array-like (n_tracks x n_features) of scaled library rows
+    :param normalized: set to True when matrix is already L2-normalized float32 (e.g. loaded from disk)
+    """
+
+    def __init__(self, matrix, normalized=False):
+        # keep the library as unit-length float32 rows so cosine similarity is a dot product
+        self.normed = matrix if normalized else normalize_rows(matrix)
+
+    def __len__(self):
+        return self.normed.shape[0]
+
+    def query(self, vector, k=10):
+        """
+        Finds the k library rows closest to a query vector by cosine distance.
+        :param vector: a 1D (or 1 x n_features) array-like in the same scaled space as the library
+        :param k: number of recommendations to return
+        :return index: a np array of library row positions ordered from nearest to farthest
+        :return distances: a np array of the matching cosine distances
+        """
+        # flatten the query and normalize it so the dot product is the cosine similarity
+        vector = normalize_rows(np.asarray(vector).reshape(1, -1))[0]
+        # score the whole library with a single matrix-vector product
+        scores = self.normed @ vector
+        # keep only the k best rows
+        index = top_k(scores, k)
+        # cosine distance is 1 - cosine similarity
+        return index, 1 - scores[index]
+
+    def query_batch(self, matrix, k=10, block_size=BLOCK_SIZE, query_block_size=256):
+        """
+        Finds the k library rows closest to each of many query vectors. The library is scored in blocks
+        of block_size rows and the queries in blocks of query_block_size, keeping a running top-k per
+        query, so at most query_block_size x block_size scores are held at once.
+        :param matrix: a 2D array-like (n_queries x n_features) in the same scaled space as the library
+        :param k: number of recommendations per query
+        :param block_size: library rows scored per block
+        :param query_block_size: queries scored per block
+        :return index: a 2D np array (n_queries x k) of library row positions, nearest first
+        :return distances: a 2D np array (n_queries x k) of the matching cosine distances
+        """
+        queries = normalize_rows(np.asarray(matrix).reshape(-1, self.normed.shape[1]))
+        n_queries, n_rows = queries.shape[0], self.normed.shape[0]
+        k = min(k, n_rows)
+        index = np.empty((n_queries, k), dtype=np.int64)
+        best_scores = np.empty((n_queries, k), dtype=np.float32)
+        for q_start in range(0, n_queries, query_block_size):
+            block_queries = queries[q_start:q_start + query_block_size]
+            scores = np.empty((block_queries.shape[0], 0), dtype=np.float32)
+            ids = np.empty((block_queries.shape[0], 0), dtype=np.int64)
+            for start in range(0, n_rows, block_size):
+                # one GEMM per block of library rows
+                block_scores = block_queries @ self.normed[start:start + block_size].T
+                block_ids = np.broadcast_to(np.arange(start, start + block_scores.shape[1]), block_scores.shape)
+                # merge the block with the best candidates seen so far
+                scores, ids = top_k_rows(np.hstack([scores, block_scores]), np.hstack([ids, block_ids]), k)
+            index[q_start:q_start + block_queries.shape[0]] = ids
+            best_scores[q_start:q_start + block_queries.shape[0]] = scores
+        return index, 1 - best_scores
+
+
+######################################################################################################
+# Quantized Engine
+######################################################################################################
+# The normalized library only needs to be resident for the first pass of a search. Quantizing each
+# feature to int8 (or casting to float16) with a per-feature scale and offset keeps a 4x (2x) smaller copy
+# in memory to score every row, and only the few hundred best candidates are re-ranked against the exact
+# float32 rows, which can stay memory-mapped on disk.
+
+QUANTIZED_DTYPES = ('int8', 'float16')
+# candidates re-ranked exactly per requested recommendation
+RERANK_FACTOR = 10
+
+
+def quantize(matrix, dtype='int8'):
+    """
+    Quantizes each column of a matrix to a smaller dtype with a per-column scale and offset, such that
+    matrix ~= quantized * scale + offset.
+    :param matrix: a 2D array-like of normalized library rows
+    :param dtype: 'int8' or 'float16'
+    :return quantized: a np array of dtype shaped like matrix
+    :return scale: a float32 np array of one scale per column
+    :return offset: a float32 np array of one offset per column
+    """
+    if dtype not in QUANTIZED_DTYPES:
+        raise ValueError(f"Unsupported quantized dtype {dtype!r}, expected one of {QUANTIZED_DTYPES}")
+    matrix = np.asarray(matrix, dtype=np.float32)
+    if dtype == 'float16':
+        # float16 keeps enough precision for unit-length rows without any rescaling
+        ones, zeros = np.ones(matrix.shape[1], dtype=np.float32), np.zeros(matrix.shape[1], dtype=np.float32)
+        return matrix.astype(np.float16), ones, zeros
+    low, high = matrix.min(axis=0), matrix.max(axis=0)
+    # spread every column's range over the 256 int8 levels, constant columns keep a scale of 1
+    scale = (high - low) / 255
+    scale[scale == 0] = 1
+    offset = low + 128 * scale
+    quantized = np.clip(np.rint((matrix - offset) / scale), -128, 127).astype(np.int8)
+    return quantized, scale.astype(np.float32), offset.astype(np.float32)
+
+
+class QuantizedEngine:
+    """
+    Cosine top-k search that scores a quantized copy of the library and re-ranks the best candidates
+    exactly. Answers the same queries as TopKEngine.
+    :param quantized: a 2D np array of quantized normalized library rows, as returned by quantize
+    :param scale: a np array of the per-column scales
+    :param offset: a np array of the per-column offsets
+    :param exact: a float32 np array (may be memory-mapped) of the normalized rows used for the re-rank,
+        None returns the approximate scores
+    :param rerank_factor: candidates re-ranked per requested recommendation
+    """
+
+    def __init__(self, quantized, scale, offset, exact=None, rerank_factor=RERANK_FACTOR):
+        self.quantized = quantized
+        self.scale = np.asarray(scale, dtype=np.float32)
+        self.offset = np.asarray(offset, dtype=np.float32)
+        self.exact = exact
+        self.rerank_factor = rerank_factor
+
+    def __len__(self):
+        return self.quantized.shape[0]
+
+    def _approximate_scores(self, queries, start, stop=None):
+        # (q * scale + offset) @ v == q @ (scale * v) + offset @ v, so the block is never dequantized
+        # start may also be an array of row positions, e.g. the rows of the probed partitions
+        rows = start if stop is None else slice(start, stop)
+        block = self.quantized[rows].astype(np.float32)
+        return block @ (queries * self.scale).T + queries @ self.offset
+
+    def query(self, vector, k=10):
+        """
+        Finds the k library rows closest to a query vector by cosine distance.
+        :param vector: a 1D (or 1 x n_features) array-like in the same scaled space as the library
+        :param k: number of recommendations to return
+        :return index: a np array of library row positions ordered from nearest to farthest
+        :return distances: a np array of the matching cosine distances
+        """
+        index, distances = self.query_batch(np.asarray(vector).reshape(1, -1), k=k)
+        return index[0], distances[0]
+
+    def query_rows(self, vector, positions, k=10):
+        """
+        Like query, but only scores the given rows, e.g. the partitions an IVF index probes. The quantized
+        rows are scored and only the best k x rerank_factor candidates are read from the exact rows.
+        :param vector: a 1D (or 1 x n_features) array-like in the same scaled space as the library
+        :param positions: a 1D np array of the library row positions to score
+        :param k: number of recommendations to return
+        :return index: a np array of library row positions ordered from nearest to farthest
+        :return distances: a np array of the matching cosine distances
+        """
+        vector = normalize_rows(np.asarray(vector).reshape(1, -1))[0]
+        scores = self._approximate_scores(vector[None, :], positions).ravel()
+        if self.exact is None:
+            best = top_k(scores, k)
+            return positions[best], 1 - scores[best]
+        # re-score the candidates on the exact rows, reading them in sorted order for the mmap
+        candidates = np.sort(positions[top_k(scores, k * self.rerank_factor)])
+        exact_scores = np.asarray(self.exact[candidates], dtype=np.float32) @ vector
+        best = top_k(exact_scores, k)
+        return candidates[best], 1 - exact_scores[best]
+
+    def query_batch(self, matrix, k=10, block_size=BLOCK_SIZE, query_block_size=256):
+        """
+        Finds the k library rows closest to each of many query vectors, scoring the quantized library in
+        blocks and re-ranking k x rerank_factor candidates per query against the exact rows.
+        :param matrix: a 2D array-like (n_queries x n_features) in the same scaled space as the library
+        :param k: number of recommendations per query
+        :param block_size: library rows scored per block
+        :param query_block_size: queries scored per block
+        :return index: a 2D np array (n_queries x k) of library row positions, nearest first
+        :return distances: a 2D np array (n_queries x k) of the matching cosine distances
+        """
+        queries = normalize_rows(np.asarray(matrix).reshape(-1, self.quantized.shape[1]))
+        n_queries, n_rows = queries.shape[0], self.quantized.shape[0]
+        k = min(k, n_rows)
+        n_candidates = k if self.exact is None else min(n_rows, k * self.rerank_factor)
+        index = np.empty((n_queries, k), dtype=np.int64)
+        best_scores = np.empty((n_queries, k), dtype=np.float32)
+        for q_start in range(0, n_queries, query_block_size):
+            block_queries = queries[q_start:q_start + query_block_size]
+            scores = np.empty((block_queries.shape[0], 0), dtype=np.float32)
+            ids = np.empty((block_queries.shape[0], 0), dtype=np.int64)
+            for start in range(0, n_rows, block_size):
+                block_scores = self._approximate_scores(block_queries, start, start + block_size).T
+                block_ids = np.broadcast_to(np.arange(start, start + block_scores.shape[1]), block_scores.shape)
+                scores, ids = top_k_rows(np.hstack([scores, block_scores]), np.hstack([ids, block_ids]),
+                                         n_candidates)
+            if self.exact is not None:
+                # re-score the candidates on the exact rows, reading them in sorted order for the mmap
+                rows = np.unique(ids)
+                exact_rows = np.asarray(self.exact[rows], dtype=np.float32)
+                scores = np.einsum('qcd,qd->qc', exact_rows[np.searchsorted(rows, ids)], block_queries)
+                scores, ids = top_k_rows(scores, ids, k)
+            index[q_start:q_start + block_queries.shape[0]] = ids
+            best_scores[q_start:q_start + block_queries.shape[0]] = scores
+        return index, 1 - best_scores
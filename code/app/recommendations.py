@@ -0,0 +1,88 @@
+import json
+import pandas as pd
+import get_methods
+import library_cache
+import result_cache
+import viz_model_methods
+
+CATEGORY_OPTIONS = ['Tracks', 'Genres', 'Artists']
+# search function per category, each takes the client and the dataframe of seeds
+SEARCH_METHODS = {
+    'Tracks': get_methods.search_tracks,
+    'Genres': get_methods.search_genre_tracks,
+    'Artists': get_methods.search_artist_tracks,
+}
+# fields every seed of a category needs, as entered in the app's forms
+SEED_FIELDS = {
+    'Tracks': ('name', 'artist', 'year'),
+    'Genres': ('genre',),
+    'Artists': ('artist_name',),
+}
+# the app caps every category at five seeds
+MAX_SEEDS = 5
+# columns returned to callers outside the app
+SHOW_COLUMNS = ['id', 'track_name', 'artist', 'release_year']
+
+
+######################################################################################################
+# Recommendations for Seeds
+######################################################################################################
+# The search -> prepare -> recommend chain shared by the Streamlit app and the HTTP service.
+
+def make_seeds(category, seeds):
+    """
+    Validates seeds given outside the app and frames them like the app's forms do.
+    :param category: one of CATEGORY_OPTIONS
+    :param seeds: a list of seed dicts, e.g. [{'artist_name': 'Daft Punk'}]
+    :return seeds: a pandas DataFrame of the seeds
+    """
+    if category not in SEED_FIELDS:
+        raise ValueError(f"Unknown category {category!r}, expected one of {CATEGORY_OPTIONS}")
+    if not isinstance(seeds, list) or not seeds:
+        raise ValueError("Seeds must be a non-empty list.")
+    if len(seeds) > MAX_SEEDS:
+        raise ValueError(f"At most {MAX_SEEDS} seeds are allowed.")
+    fields = SEED_FIELDS[category]
+    for seed in seeds:
+        if not isinstance(seed, dict) or any(seed.get(field) in (None, '') for field in fields):
+            raise ValueError(f"Every seed needs the fields {list(fields)}.")
+    return pd.DataFrame([{field: seed[field] for field in fields} for seed in seeds])
+
+
+def get_recommendations(sp, category, seeds, k=10, cache=None):
+    """
+    Searches the seeds and recommends songs for them, reusing the result of any earlier request in this
+    process for the same category and seeds in any order.
+    :param sp: spotipy client
+    :param category: one of CATEGORY_OPTIONS
+    :param seeds: a pandas DataFrame of the seeds the user entered
+    :param k: number of recommendations
+    :param cache: an optional result_cache.ResultCache, defaults to the process-wide cache
+    :return tracks_for_model: a pandas DataFrame of the resolved seed tracks
+    :return rec_songs_full: a pandas DataFrame of the recommended songs and their audio features
+    :return rec_songs: a pandas DataFrame of the recommended songs to show
+    """
+    if category not in SEARCH_METHODS:
+        raise ValueError(f"Unknown category {category!r}, expected one of {CATEGORY_OPTIONS}")
+    cache = cache or result_cache.get_default_cache()
+    key = result_cache.make_key(category, seeds.to_dict('records'), library_cache.get_library().version, k)
+
+    def compute():
+        tracks_for_model = SEARCH_METHODS[category](sp, seeds)
+        # recommend around each genre's cluster instead of the midpoint of all genres
+        n_centroids = len(seeds) if category == 'Genres' else 1
+        rec_songs_full, rec_songs = viz_model_methods.song_recommendations(tracks_for_model, k=k, n_centroids=n_centroids)
+        return tracks_for_model, rec_songs_full, rec_songs
+
+    return cache.get_or_compute(key, compute)
+
+
+def to_records(df, columns=SHOW_COLUMNS):
+    """
+    Converts tracks to JSON friendly records, numpy scalars and NaN become plain values.
+    :param df: a pandas DataFrame of tracks
+    :param columns: the columns to keep, missing ones are skipped
+    :return records: a list of dicts
+    """
+    df = df[[column for column in columns if column in df.columns]]
+    return json.loads(df.to_json(orient='records'))
@@ -0,0 +1,133 @@
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+# seconds a cached recommendation stays fresh and the largest number kept per process
+RESULT_TTL = int(os.getenv("SONGSUGGEST_RESULT_TTL", "3600"))
+MAX_RESULTS = int(os.getenv("SONGSUGGEST_RESULT_CACHE_SIZE", "1024"))
+_NUMBER = re.compile(r"[+-]?\d+(\.\d+)?")
+
+
+######################################################################################################
+# Recommendation Result Cache
+######################################################################################################
+# Streamlit reruns the script on every interaction and many users ask for the same popular artists and
+# genres, so the search -> prepare -> recommend chain is cached per process. Keys ignore the order, case
+# and spacing of the seeds, so 'Daft Punk, Justice' and ' justice,daft punk' share one entry, and a year
+# entered as '2019' matches 2019. Repeated seeds are kept, they change the recommendations.
+
+def _normalize(value):
+    # strings compare case and whitespace insensitively, numbers compare by value
+    if isinstance(value, str):
+        value = ' '.join(value.split()).casefold()
+        # a numeric string, e.g. a year from a form field, is the number it spells
+        if not _NUMBER.fullmatch(value):
+            return value
+        value = float(value)
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def make_key(category, seeds, version=None, k=10):
+    """
+    Builds the canonical cache key of a recommendation request.
+    :param category: one of the app's CATEGORY_OPTIONS, e.g. 'Artists'
+    :param seeds: a list of seed dicts, e.g. [{'artist_name': 'Daft Punk'}]
+    :param version: optional version of the library the results come from, so a reload misses
+    :param k: number of recommendations requested
+    :return key: a hashable tuple that is the same for any ordering of the same seeds
+    """
+    # a multiset, repeated seeds weigh in (Genres uses one centroid per seed) so they are not collapsed
+    canonical = [tuple(sorted((name, _normalize(value)) for name, value in seed.items())) for seed in seeds]
+    return category, tuple(sorted(canonical, key=repr)), version, k
+
+
+class ResultCache:
+    """
+    Thread-safe LRU cache with a per-entry TTL, shared by every session in the process.
+    :param max_entries: the largest number of results kept, the least recently used is evicted first
+    :param ttl: seconds a result stays fresh, None keeps results until they are evicted
+    """
+
+    def __init__(self, max_entries=MAX_RESULTS, ttl=RESULT_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        :param key: a key from make_key
+        :return value: the cached value, or None when it is missing or stale
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (self.ttl is None or time.monotonic() - entry[0] < self.ttl):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        """
+        Stores a value, evicting the least recently used entries past max_entries.
+        :param key: a key from make_key
+        :param value: the result to cache, callers must treat it as read-only
+        """
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_compute(self, key, compute):
+        """
+        Returns the cached value for key, computing and caching it on a miss. Errors are not cached.
+        :param key: a key from make_key
+        :param compute: a function with no arguments that produces the value
+        :return value: the cached or freshly computed value
+        """
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def stats(self):
+        """
+        :return stats: a dict of hits, misses, evictions, the current size and the hit rate
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'size': len(self._entries), 'hit_rate': self.hits / lookups if lookups else 0.0}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_default_cache = None
+_default_lock = threading.Lock()
+
+
+def get_default_cache():
+    """
+    Creates the process-wide result cache on first use.
+    :return cache: a ResultCache
+    """
+    global _default_cache
+    with _default_lock:
+        if _default_cache is None:
+            _default_cache = ResultCache()
+        return _default_cache
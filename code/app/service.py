@@ -0,0 +1,146 @@
+import argparse
+import json
+import logging
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import library_cache
+import metadata_cache
+import result_cache
+from get_methods import NoSeedTracksError
+from recommendations import get_recommendations, make_seeds, to_records
+
+logger = logging.getLogger(__name__)
+
+HOST = os.getenv("SONGSUGGEST_HOST", "127.0.0.1")
+PORT = int(os.getenv("SONGSUGGEST_PORT", "8000"))
+MAX_K = 100
+# endpoint path to category
+ENDPOINTS = {
+    '/recommend/tracks': 'Tracks',
+    '/recommend/artists': 'Artists',
+    '/recommend/genres': 'Genres',
+}
+
+
+######################################################################################################
+# Headless Recommendation Service
+######################################################################################################
+# Serves the app's recommendation pipeline over HTTP so other services can call it without Streamlit.
+# The library, scaler and Spotify client are loaded once at startup and shared by every request thread.
+#
+#   POST /recommend/tracks   {"seeds": [{"name": ..., "artist": ..., "year": ...}], "k": 10}
+#   POST /recommend/artists  {"seeds": [{"artist_name": ...}]}
+#   POST /recommend/genres   {"seeds": [{"genre": ...}]}
+#   GET  /health             library size and version
+#   GET  /stats              result cache, metadata cache and Spotify throttling counters
+
+def parse_request(path, body):
+    """
+    Validates a recommendation request.
+    :param path: the request path, one of ENDPOINTS
+    :param body: the decoded JSON body
+    :return category: the app category for the endpoint
+    :return seeds: a pandas DataFrame of the seeds
+    :return k: number of recommendations
+    """
+    category = ENDPOINTS[path]
+    if not isinstance(body, dict):
+        raise ValueError("Request body must be a JSON object with a 'seeds' list.")
+    seeds = make_seeds(category, body.get('seeds'))
+    k = body.get('k', 10)
+    # JSON true and false are ints to python, they are not a count
+    if isinstance(k, bool) or not isinstance(k, int) or not 0 < k <= MAX_K:
+        raise ValueError(f"k must be an integer between 1 and {MAX_K}.")
+    return category, seeds, k
+
+
+class RecommendationHandler(BaseHTTPRequestHandler):
+    # the warm Spotify client shared by every request, set by make_server
+    sp = None
+
+    def _send(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/health':
+            library = library_cache.get_library()
+            self._send(200, {'status': 'ok', 'tracks': len(library), 'version': list(library.version or ())})
+        elif self.path == '/stats':
+            stats = {'results': result_cache.get_default_cache().stats(),
+                     'metadata': metadata_cache.get_default_cache().stats()}
+            if hasattr(self.sp, 'throttle_stats'):
+                stats['spotify'] = self.sp.throttle_stats()
+            self._send(200, stats)
+        else:
+            self._send(404, {'error': f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path not in ENDPOINTS:
+            self._send(404, {'error': f"Unknown path {self.path}"})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            category, seeds, k = parse_request(self.path, json.loads(self.rfile.read(length) or b'null'))
+        except (ValueError, json.JSONDecodeError) as e:
+            self._send(400, {'error': str(e)})
+            return
+        try:
+            tracks_for_model, rec_songs_full, rec_songs = get_recommendations(self.sp, category, seeds, k=k)
+        except NoSeedTracksError as e:
+            self._send(400, {'error': str(e)})
+            return
+        except Exception:
+            logger.exception("Recommendation failed for %s", self.path)
+            self._send(502, {'error': "Could not resolve the seeds or recommend songs for them."})
+            return
+        self._send(200, {
+            'category': category,
+            'seed_tracks': to_records(tracks_for_model),
+            'recommendations': to_records(rec_songs_full),
+        })
+
+    def log_message(self, format, *args):
+        logger.info("%s - %s", self.address_string(), format % args)
+
+
+def make_server(sp, host=HOST, port=PORT):
+    """
+    Warms the library and builds the threaded HTTP server.
+    :param sp: the spotipy client (or StubSpotify) every request uses
+    :param host: interface to bind
+    :param port: port to bind, 0 picks a free one
+    :return server: a ThreadingHTTPServer, call serve_forever to start it
+    """
+    library_cache.get_library()
+    handler = type('BoundRecommendationHandler', (RecommendationHandler,), {'sp': sp})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve song recommendations over HTTP.")
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--stub', action='store_true',
+                        help="answer Spotify calls from the local library instead of the Web API")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.stub:
+        from stub_spotify import StubSpotify
+        # keep stub answers out of the shared metadata cache file
+        metadata_cache.set_default_cache(metadata_cache.MetadataCache(':memory:'))
+        sp = StubSpotify.from_library(library_cache.get_library())
+    else:
+        from user_session import UserSession
+        session = UserSession()
+        session.authenticate()
+        sp = session.access_token
+    server = make_server(sp, args.host, args.port)
+    logger.info("Serving recommendations on http://%s:%s", *server.server_address[:2])
+    server.serve_forever()
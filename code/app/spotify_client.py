@@ -0,0 +1,161 @@
+import functools
+import random
+import threading
+import time
+import requests
+import spotipy
+from spotipy.exceptions import SpotifyException
+
+# sustained requests per second and burst size shared by every client in the process
+REQUESTS_PER_SECOND = 10
+BURST = 20
+MAX_RETRIES = 5
+BASE_DELAY = 1.0
+MAX_DELAY = 30.0
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+######################################################################################################
+# Token Bucket
+######################################################################################################
+
+class TokenBucket:
+    """
+    Thread-safe token bucket. Every request takes one token; when the bucket is empty callers wait for it
+    to refill. A 429 pauses the whole bucket, so every thread and session sharing it backs off together.
+    :param rate: tokens added per second
+    :param capacity: the largest number of tokens held, i.e. the allowed burst
+    """
+
+    def __init__(self, rate=REQUESTS_PER_SECOND, capacity=BURST):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.waited_seconds = 0.0
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Takes one token, sleeping until it is available.
+        :return waited: seconds spent waiting
+        """
+        with self._lock:
+            now = time.monotonic()
+            # refill for the time since the last request, up to capacity
+            self.tokens = min(self.capacity, self.tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            # reserve a token now, a negative balance is paid off by waiting
+            self.tokens -= 1
+            wait = max(-self.tokens / self.rate, self._paused_until - now, 0.0)
+            self.waited_seconds += wait
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def pause(self, seconds):
+        """
+        Stops handing out tokens for the given number of seconds.
+        :param seconds: how long every caller should wait
+        """
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+DEFAULT_BUCKET = TokenBucket()
+
+
+######################################################################################################
+# Rate Limited Client
+######################################################################################################
+
+class RateLimitedSpotify:
+    """
+    Wraps a spotipy.Spotify so every API call is paced by a shared TokenBucket and retried on 429 and 5xx
+    responses and connection errors. 429s wait for the Retry-After header, everything else backs off
+    exponentially with full jitter. Any attribute of the wrapped client is available on the wrapper.
+    :param sp: a spotipy.Spotify object
+    :param bucket: the TokenBucket to pace calls with, defaults to the process-wide bucket
+    :param max_retries: retries per call before the error is raised
+    :param base_delay: seconds of the first backoff step, doubled on every retry
+    :param max_delay: the longest backoff in seconds
+    """
+
+    def __init__(self, sp, bucket=None, max_retries=MAX_RETRIES, base_delay=BASE_DELAY, max_delay=MAX_DELAY):
+        self.sp = sp
+        self.bucket = bucket or DEFAULT_BUCKET
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retries = 0
+        self.retry_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        attribute = getattr(self.sp, name)
+        if not callable(attribute):
+            return attribute
+
+        @functools.wraps(attribute)
+        def call(*args, **kwargs):
+            return self._call(attribute, *args, **kwargs)
+
+        return call
+
+    def _call(self, method, *args, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+            try:
+                return method(*args, **kwargs)
+            except SpotifyException as e:
+                if e.http_status not in RETRY_STATUSES or attempt == self.max_retries:
+                    raise
+                delay = self._retry_after(e)
+                if delay is not None:
+                    # every caller sharing the bucket waits out the rate limit window
+                    self.bucket.pause(delay)
+                else:
+                    delay = self._backoff(attempt)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.max_retries:
+                    raise
+                delay = self._backoff(attempt)
+            with self._lock:
+                self.retries += 1
+                self.retry_seconds += delay
+            time.sleep(delay)
+
+    def _retry_after(self, error):
+        if error.http_status != 429 or not error.headers:
+            return None
+        try:
+            # a little jitter keeps paused threads from retrying in lockstep
+            return float(error.headers.get('Retry-After')) + random.uniform(0, self.base_delay)
+        except (TypeError, ValueError):
+            return None
+
+    def _backoff(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def throttle_stats(self):
+        """
+        :return stats: a dict of seconds spent waiting on the shared bucket, seconds spent sleeping before
+            retries by this client, and the number of retries
+        """
+        return {
+            'bucket_wait_seconds': self.bucket.waited_seconds,
+            'retry_seconds': self.retry_seconds,
+            'retries': self.retries,
+        }
+
+
+def make_client(bucket=None, **kwargs):
+    """
+    Creates a rate limited spotipy client. spotipy is given a plain requests session so it does not retry
+    on its own and every 429 reaches RateLimitedSpotify with its Retry-After header.
+    :param bucket: the TokenBucket to pace calls with, defaults to the process-wide bucket
+    :param kwargs: passed to spotipy.Spotify, e.g. auth or client_credentials_manager
+    :return sp: a RateLimitedSpotify
+    """
+    return RateLimitedSpotify(spotipy.Spotify(requests_session=requests.Session(), **kwargs), bucket=bucket)
@@ -0,0 +1,158 @@
+import ast
+import re
+import numpy as np
+import pandas as pd
+
+AUDIO_FEATURE_COLUMNS = ['danceability', 'energy', 'key', 'loudness', 'mode', 'speechiness', 'acousticness',
+                         'instrumentalness', 'liveness', 'valence', 'tempo', 'duration_ms', 'time_signature']
+# matches the field:value filters of a Spotify search query, e.g. "track:Hey Jude artist:The Beatles"
+_QUERY_FILTER = re.compile(r'(\w+):(.*?)(?=\s+\w+:|$)')
+
+
+######################################################################################################
+# Stub Spotify Backend
+######################################################################################################
+# Answers the handful of spotipy calls get_methods makes (search, artist_top_tracks, tracks,
+# audio_features and artists) from a local track frame, normally the recommendation library itself.
+# The app, service and batch jobs can then run offline and deterministically, without credentials.
+
+def _parse_list(value):
+    # the library stores genres and artist ids as the string form of a python list
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return list(value)
+    if not isinstance(value, str) or not value:
+        return []
+    if value.startswith('['):
+        try:
+            return list(ast.literal_eval(value))
+        except (ValueError, SyntaxError):
+            return []
+    return [value]
+
+
+def _strip_uri(uri):
+    # accept both 'spotify:artist:<id>' uris and bare ids
+    return uri.rsplit(':', 1)[-1]
+
+
+class StubSpotify:
+    """
+    In-memory stand-in for spotipy.Spotify backed by a dataframe of tracks.
+    :param tracks: a pandas DataFrame with at least id, track_name, artist and the audio feature columns,
+        optionally artist_uri or id_artists, album, album_uri, release_date, release_year, popularity,
+        explicit and genres
+    :param limit: the default number of search results, like the Web API
+    """
+
+    def __init__(self, tracks, limit=10):
+        tracks = tracks.reset_index(drop=True)
+        self.limit = limit
+        self.frame = tracks
+        self.genres = tracks['genres'].map(_parse_list) if 'genres' in tracks else pd.Series([[]] * len(tracks))
+        if 'artist_uri' in tracks:
+            self.artist_ids = tracks['artist_uri'].astype(str).map(_strip_uri)
+        elif 'id_artists' in tracks:
+            self.artist_ids = tracks['id_artists'].map(lambda ids: (_parse_list(ids) or [''])[0])
+        else:
+            self.artist_ids = tracks['artist'].astype(str).str.casefold()
+        self.row_by_id = pd.Series(np.arange(len(tracks)), index=tracks['id'].astype(str))
+        self.row_by_id = self.row_by_id[~self.row_by_id.index.duplicated()]
+        # every row of each artist, in library order
+        self.artist_rows = self.artist_ids.groupby(self.artist_ids, sort=False).indices
+        self._names = tracks['track_name'].astype(str).str.casefold()
+        self._artists = tracks['artist'].astype(str).str.casefold()
+
+    @classmethod
+    def from_library(cls, library):
+        """
+        :param library: a library_cache.LoadedLibrary
+        :return sp: a StubSpotify serving every track of the library
+        """
+        return cls(library.store.take(np.arange(len(library.store))))
+
+    ##################################################################################################
+    # Object Builders
+    ##################################################################################################
+
+    def _artist(self, row):
+        artist_id = self.artist_ids.iat[row]
+        return {'id': artist_id, 'uri': f"spotify:artist:{artist_id}", 'name': self.frame['artist'].iat[row],
+                'genres': self.genres.iat[row]}
+
+    def _track(self, row):
+        track = self.frame.iloc[row]
+        release_date = track.get('release_date')
+        if not isinstance(release_date, str) or not release_date:
+            release_date = str(int(track['release_year'])) if 'release_year' in track else ''
+        return {
+            'id': track['id'],
+            'name': track['track_name'],
+            'artists': [self._artist(row)],
+            'album': {'uri': track.get('album_uri', f"spotify:album:{track['id']}"),
+                      'name': track.get('album', ''), 'release_date': release_date},
+            'popularity': int(track.get('popularity', 0)),
+            'explicit': bool(track.get('explicit', 0)),
+        }
+
+    def _audio_features(self, row):
+        track = self.frame.iloc[row]
+        features = {name: track[name].item() if hasattr(track[name], 'item') else track[name]
+                    for name in AUDIO_FEATURE_COLUMNS if name in track}
+        return dict(features, id=track['id'], type='audio_features', uri=f"spotify:track:{track['id']}",
+                    track_href='', analysis_url='')
+
+    ##################################################################################################
+    # spotipy API
+    ##################################################################################################
+
+    def search(self, q, limit=None, offset=0, type='track', market=None):
+        """
+        Supports the track, artist, year and genre filters get_methods builds. Filters match
+        case-insensitively, track and artist by substring, genre by list membership.
+        """
+        filters = {field.casefold(): value.strip().casefold() for field, value in _QUERY_FILTER.findall(q)}
+        mask = np.ones(len(self.frame), dtype=bool)
+        if 'track' in filters:
+            mask &= self._names.str.contains(filters['track'], regex=False).to_numpy()
+        if 'artist' in filters:
+            mask &= self._artists.str.contains(filters['artist'], regex=False).to_numpy()
+        if 'year' in filters and 'release_year' in self.frame:
+            mask &= (self.frame['release_year'].astype(str) == filters['year']).to_numpy()
+        if 'genre' in filters:
+            mask &= self.genres.map(lambda genres: filters['genre'] in [g.casefold() for g in genres]).to_numpy()
+        rows = np.flatnonzero(mask)
+        # exact name matches first, then the most popular, a rough stand-in for Spotify's relevance ordering
+        popularity = self.frame['popularity'].to_numpy()[rows] if 'popularity' in self.frame else np.zeros(len(rows))
+        exact = np.zeros(len(rows), dtype=int)
+        if 'track' in filters:
+            exact += (self._names.to_numpy()[rows] == filters['track'])
+        if 'artist' in filters:
+            exact += (self._artists.to_numpy()[rows] == filters['artist'])
+        rows = rows[np.lexsort((-popularity, -exact))]
+        limit = limit or self.limit
+        if type == 'artist':
+            artists, seen = [], set()
+            for row in rows:
+                if self.artist_ids.iat[row] not in seen:
+                    seen.add(self.artist_ids.iat[row])
+                    artists.append(self._artist(row))
+            return {'artists': {'items': artists[offset:offset + limit], 'total': len(artists)}}
+        return {'tracks': {'items': [self._track(row) for row in rows[offset:offset + limit]], 'total': len(rows)}}
+
+    def artist_top_tracks(self, artist_id, country='US'):
+        rows = self.artist_rows.get(_strip_uri(artist_id), np.empty(0, dtype=np.int64))
+        if 'popularity' in self.frame:
+            rows = rows[np.argsort(-self.frame['popularity'].to_numpy()[rows], kind='stable')]
+        return {'tracks': [self._track(row) for row in rows[:10]]}
+
+    def tracks(self, tracks, market=None):
+        rows = [self.row_by_id.get(_strip_uri(track_id)) for track_id in tracks]
+        return {'tracks': [None if row is None else self._track(row) for row in rows]}
+
+    def audio_features(self, tracks=[]):
+        rows = [self.row_by_id.get(_strip_uri(track_id)) for track_id in tracks]
+        return [None if row is None else self._audio_features(row) for row in rows]
+
+    def artists(self, artists):
+        rows = [self.artist_rows.get(_strip_uri(artist_id)) for artist_id in artists]
+        return {'artists': [None if row is None else self._artist(row[0]) for row in rows]}
@@ -0,0 +1,134 @@
+import json
+import numpy as np
+
+
+######################################################################################################
+# Taste Profile
+######################################################################################################
+# A user's signal is the centroid of their tracks' audio features. TasteProfile keeps that centroid
+# together with the track count and the running sum of squared deviations (M2), so tracks can be added
+# or removed without revisiting the rest of the library, and so the profile can be stored and reused
+# instead of rebuilding a dataframe of tracks for every recommendation.
+
+def _block_stats(block):
+    # count, mean and sum of squared deviations of a 2D block, computed column-wise in one pass each
+    count = block.shape[0]
+    if count == 0:
+        return 0, np.zeros(block.shape[1]), np.zeros(block.shape[1])
+    mean = block.mean(axis=0)
+    m2 = ((block - mean) ** 2).sum(axis=0)
+    return count, mean, m2
+
+
+class TasteProfile:
+    """
+    Running mean and variance of a user's track audio features.
+    :param columns: the audio feature column names, in vector order
+    :param count: number of tracks in the profile
+    :param mean: a np array of the per-column mean
+    :param m2: a np array of the per-column sum of squared deviations from the mean
+    """
+
+    def __init__(self, columns, count=0, mean=None, m2=None):
+        self.columns = list(columns)
+        self.count = count
+        self.mean = np.zeros(len(self.columns)) if mean is None else np.asarray(mean, dtype=np.float64)
+        self.m2 = np.zeros(len(self.columns)) if m2 is None else np.asarray(m2, dtype=np.float64)
+
+    @classmethod
+    def from_frame(cls, df, columns):
+        """
+        Builds a profile straight from the column block of a track dataframe.
+        :param df: a pandas DataFrame of tracks and their audio features
+        :param columns: the audio feature column names to profile
+        :return profile: a TasteProfile
+        """
+        profile = cls(columns)
+        profile.add(df)
+        return profile
+
+    def _block(self, df):
+        block = df[self.columns].to_numpy(dtype=np.float64)
+        # tracks missing any audio feature cannot contribute to the centroid
+        return block[~np.isnan(block).any(axis=1)]
+
+    def add(self, df):
+        """
+        Adds tracks to the profile, merging their statistics with the current ones.
+        :param df: a pandas DataFrame of the tracks to add
+        :return profile: self
+        """
+        count, mean, m2 = _block_stats(self._block(df))
+        if count == 0:
+            return self
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * count / total
+        self.m2 = self.m2 + m2 + delta ** 2 * self.count * count / total
+        self.count = total
+        return self
+
+    def remove(self, df):
+        """
+        Removes tracks that were previously added, reversing their contribution to the statistics.
+        :param df: a pandas DataFrame of the tracks to remove
+        :return profile: self
+        """
+        count, mean, m2 = _block_stats(self._block(df))
+        if count == 0:
+            return self
+        if count > self.count:
+            raise ValueError("Cannot remove more tracks than the profile holds.")
+        remaining = self.count - count
+        if remaining == 0:
+            # an empty profile has no centroid, start over from zeros
+            self.count, self.mean, self.m2 = 0, np.zeros(len(self.columns)), np.zeros(len(self.columns))
+            return self
+        remaining_mean = (self.count * self.mean - count * mean) / remaining
+        delta = mean - remaining_mean
+        self.m2 = np.maximum(self.m2 - m2 - delta ** 2 * remaining * count / self.count, 0)
+        self.mean = remaining_mean
+        self.count = remaining
+        return self
+
+    @property
+    def variance(self):
+        """
+        :return variance: a np array of the per-column population variance
+        """
+        return self.m2 / self.count if self.count else np.zeros(len(self.columns))
+
+    def vector(self, columns=None):
+        """
+        Returns the centroid, optionally reordered to match another column order.
+        :param columns: optional column names the centroid should be ordered by
+        :return mean_vector: a 1D np array
+        """
+        if columns is None or list(columns) == self.columns:
+            return self.mean
+        missing = [name for name in columns if name not in self.columns]
+        if missing:
+            raise ValueError(f"Taste profile is missing columns: {missing}")
+        positions = [self.columns.index(name) for name in columns]
+        return self.mean[positions]
+
+    def to_dict(self):
+        """
+        :return profile: a JSON-serializable dict of the profile
+        """
+        return {'columns': self.columns, 'count': self.count, 'mean': self.mean.tolist(), 'm2': self.m2.tolist()}
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        :param data: a dict produced by to_dict
+        :return profile: a TasteProfile
+        """
+        return cls(data['columns'], data['count'], data['mean'], data['m2'])
+
+    def to_json(self):
+        return json.dumps(self.to_dict())
+
+    @classmethod
+    def from_json(cls, text):
+        return cls.from_dict(json.loads(text))
@@ -1,5 +1,5 @@
-import spotipy
 from spotipy.oauth2 import SpotifyClientCredentials
+from spotify_client import make_client
 import os
 
 CLIENT_ID = os.getenv("SPOTIPY_CLIENT_ID")
@@ -15,7 +15,8 @@ class UserSession:
     def authenticate(self):
 
         client_credentials_manager = SpotifyClientCredentials(client_id=CLIENT_ID, client_secret=CLIENT_SECRET)
-        sp = spotipy.Spotify(client_credentials_manager=client_credentials_manager)
+        # pace every call through the process-wide token bucket and retry 429s
+        sp = make_client(client_credentials_manager=client_credentials_manager)
         self.access_token = sp
         self.authed = True
 
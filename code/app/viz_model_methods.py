@@ -1,32 +1,150 @@
+import hashlib
+import threading
+from collections import OrderedDict
 import pandas as pd
-import matplotlib.pyplot as plt
-import plotly.express as px
+from matplotlib.figure import Figure
+from matplotlib.patches import Rectangle
 import plotly.graph_objs as go
 from sklearn.cluster import KMeans
-from sklearn.preprocessing import StandardScaler
-from scipy.spatial.distance import cdist
-from sklearn.pipeline import Pipeline
-from sklearn.decomposition import PCA
-import pickle
+import ann_index
+import library_cache
+from recommend_engine import BLOCK_SIZE, allocate_quotas, merge_with_quota
+from taste_profile import TasteProfile
 import numpy as np
 
 ######################################################################################################
 # Data Vizualization Methods
 ######################################################################################################
-def visualize_signal(df):
-    # Select the numerical features you want to display
-    features = ['danceability', 'energy', 'speechiness', 'acousticness', 'instrumentalness', 'liveness', 'valence']
+# audio features shown in the signal plots, all on a 0-1 scale, and their legend colors
+SIGNAL_FEATURES = ['danceability', 'energy', 'speechiness', 'acousticness', 'instrumentalness', 'liveness', 'valence']
+SIGNAL_COLORS = ['blue', 'orange', 'green', 'red', 'purple', 'gray', 'pink']
+# points each density is evaluated at, and the quantiles kept per feature
+GRID_SIZE = 100
+QUANTILES = [0.0, 0.25, 0.5, 0.75, 1.0]
+# signal summaries kept per process
+MAX_SUMMARIES = 128
 
-    # Create a list of colors for each violin
-    colors = ['blue', 'orange', 'green', 'red', 'purple', 'gray', 'pink']
+_summaries = OrderedDict()
+_summaries_lock = threading.Lock()
 
-    # Create the violin plot with a separate plot for each feature
-    fig, ax = plt.subplots(figsize=(12, 8))
-    handles = []
-    for i, feature in enumerate(features):
-        ax.violinplot(dataset=df[feature], positions=[i], showmeans=False, showmedians=True, widths=0.8)
-        handle = plt.Rectangle((0,0),1,1, color=colors[i], label=feature)
-        handles.append(handle)
+
+def summarize_signal(df, features=SIGNAL_FEATURES, grid_size=GRID_SIZE):
+    """
+    Computes the Gaussian KDE and quantile summary of every feature in one vectorized pass, the same
+    statistics a violin plot draws, so a plot never has to look at the raw rows again.
+    :param df: a pandas DataFrame of tracks and their audio features
+    :param features: the feature columns to summarize
+    :param grid_size: number of points each density is evaluated at
+    :return summary: a dict of features, count, grid and density (n_features x grid_size), quantiles
+        (len(QUANTILES) x n_features) and mean
+    """
+    values = df[features].to_numpy(dtype=np.float64)
+    present = ~np.isnan(values)
+    counts = present.sum(axis=0)
+    quantiles = np.nanquantile(values, QUANTILES, axis=0)
+    mean = np.nanmean(values, axis=0)
+    # Scott's rule bandwidth per feature, as matplotlib's violinplot uses, floored for constant features
+    std = np.nanstd(values, axis=0, ddof=1) if len(values) > 1 else np.zeros(len(features))
+    bandwidth = np.maximum(np.nan_to_num(std) * np.maximum(counts, 1) ** (-1 / 5), 1e-3)
+    low, high = quantiles[0], quantiles[-1]
+    flat = high <= low
+    low, high = np.where(flat, low - 3 * bandwidth, low), np.where(flat, high + 3 * bandwidth, high)
+    grid = low[:, None] + (high - low)[:, None] * np.linspace(0, 1, grid_size)[None, :]
+    # kernel of every grid point against every track, features x grid x tracks, missing values weigh 0
+    z = (grid[:, :, None] - np.nan_to_num(values).T[:, None, :]) / bandwidth[:, None, None]
+    kernel = np.exp(-0.5 * z ** 2) * present.T[:, None, :]
+    density = kernel.sum(axis=2) / (np.maximum(counts, 1) * bandwidth * np.sqrt(2 * np.pi))[:, None]
+    return {'features': list(features), 'count': counts, 'grid': grid, 'density': density,
+            'quantiles': quantiles, 'mean': mean}
+
+
+def summarize_histogram(counts, edges, features):
+    """
+    Builds a signal summary from histogram counts over precomputed bins instead of raw values. Densities
+    are a binned Gaussian KDE over the bin centers and quantiles are interpolated within bins.
+    :param counts: an np array (n_features x n_bins) of track counts per bin, e.g. from LibraryStore.histogram
+    :param edges: an np array (n_features x n_bins + 1) of bin edges
+    :param features: the feature names, in counts order
+    :return summary: a dict shaped like summarize_signal's
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    edges = np.asarray(edges, dtype=np.float64)
+    totals = counts.sum(axis=1)
+    widths = np.diff(edges, axis=1)
+    centers = edges[:, :-1] + widths / 2
+    mean = (counts * centers).sum(axis=1) / np.maximum(totals, 1)
+    quantiles = np.empty((len(QUANTILES), len(features)))
+    for i in range(len(features)):
+        filled = np.flatnonzero(counts[i])
+        if len(filled) == 0:
+            quantiles[:, i] = np.nan
+            continue
+        # walk the cumulative counts to the bin holding each quantile, then interpolate inside it
+        cumulative = np.concatenate([[0], np.cumsum(counts[i])])
+        targets = np.clip(np.asarray(QUANTILES) * totals[i], 0, totals[i])
+        position = np.clip(np.searchsorted(cumulative, targets, side='left') - 1, filled[0], filled[-1])
+        fraction = (targets - cumulative[position]) / np.maximum(counts[i][position], 1)
+        quantiles[:, i] = edges[i][position] + np.clip(fraction, 0, 1) * widths[i][position]
+    # Scott's rule on the binned variance, never narrower than a bin so sparse selections stay smooth
+    variance = (counts * (centers - mean[:, None]) ** 2).sum(axis=1) / np.maximum(totals - 1, 1)
+    bandwidth = np.maximum(np.sqrt(variance) * np.maximum(totals, 1) ** (-1 / 5), widths.max(axis=1))
+    low, high = np.nan_to_num(quantiles[0]), np.nan_to_num(quantiles[-1])
+    grid = low[:, None] + (high - low)[:, None] * np.linspace(0, 1, GRID_SIZE)[None, :]
+    # every grid point against every bin center, weighted by the bin's count
+    z = (grid[:, :, None] - centers[:, None, :]) / bandwidth[:, None, None]
+    kernel = np.exp(-0.5 * z ** 2) * counts[:, None, :]
+    density = kernel.sum(axis=2) / (np.maximum(totals, 1) * bandwidth * np.sqrt(2 * np.pi))[:, None]
+    return {'features': list(features), 'count': totals.astype(np.int64), 'grid': grid, 'density': density,
+            'quantiles': quantiles, 'mean': mean}
+
+
+def library_signal_summary(library=None, rows=None):
+    """
+    Summarizes the plotted features of library tracks from the distributions precomputed at build time.
+    :param library: a library_cache.LoadedLibrary, defaults to the process-wide one
+    :param rows: optional library row positions, None summarizes the whole library
+    :return summary: a dict shaped like summarize_signal's
+    """
+    if library is None:
+        library = library_cache.get_library()
+    store = library.store
+    if store.bins is None:
+        raise ValueError("The library has no precomputed distributions. Rebuild it with library_build.py.")
+    distributions = store.distributions
+    if rows is None:
+        summary = summarize_histogram(distributions['counts'], distributions['edges'], distributions['features'])
+        # the build kept the exact library-wide statistics
+        summary['quantiles'] = distributions['quantiles']
+        summary['mean'] = distributions['mean']
+        return summary
+    return summarize_histogram(store.histogram(rows), distributions['edges'], distributions['features'])
+
+
+def render_signal(summary):
+    """
+    Draws the violin plot of a signal summary with matplotlib.
+    :param summary: a dict from summarize_signal
+    :return fig: a matplotlib Figure
+    """
+    features = summary['features']
+    # hand matplotlib the precomputed statistics instead of the raw rows
+    stats = [{'coords': summary['grid'][i], 'vals': summary['density'][i], 'mean': summary['mean'][i],
+              'median': summary['quantiles'][2, i], 'min': summary['quantiles'][0, i],
+              'max': summary['quantiles'][-1, i]} for i in range(len(features))]
+    # a Figure outside pyplot is freed once the caller drops it instead of staying registered forever
+    fig = Figure(figsize=(12, 8))
+    ax = fig.subplots()
+    parts = ax.violin(stats, positions=range(len(features)), showmeans=False, showmedians=True, widths=0.8)
+    # one color per feature, matching the legend
+    colors = [SIGNAL_COLORS[i % len(SIGNAL_COLORS)] for i in range(len(features))]
+    for body, color in zip(parts['bodies'], colors):
+        body.set_facecolor(color)
+        body.set_edgecolor(color)
+    for name in ('cmedians', 'cmins', 'cmaxes', 'cbars'):
+        if name in parts:
+            parts[name].set_color(colors)
+    handles = [Rectangle((0, 0), 1, 1, color=SIGNAL_COLORS[i % len(SIGNAL_COLORS)], label=feature)
+               for i, feature in enumerate(features)]
 
     # Add x-axis and y-axis labels
     ax.set_xlabel('Features')
@@ -35,7 +153,7 @@ def visualize_signal(df):
     # Set the x-tick labels to be the feature names
     ax.set_xticks(range(len(features)))
     ax.set_xticklabels(features)
-    
+
     # Add gridlines
     ax.grid(axis='y', linestyle='--', alpha=0.6)
 
@@ -45,6 +163,93 @@ def visualize_signal(df):
     return fig
 
 
+def render_signal_chart(summary):
+    """
+    Draws the violins of a signal summary as a lightweight interactive plotly chart, a few hundred points
+    per feature no matter how many tracks were summarized.
+    :param summary: a dict from summarize_signal
+    :return fig: a plotly Figure
+    """
+    fig = go.Figure()
+    for i, feature in enumerate(summary['features']):
+        # mirror each density around its position to outline the violin
+        half_width = 0.4 * summary['density'][i] / max(summary['density'][i].max(), 1e-12)
+        grid = summary['grid'][i]
+        fig.add_trace(go.Scatter(
+            x=np.concatenate([i - half_width, (i + half_width)[::-1]]), y=np.concatenate([grid, grid[::-1]]),
+            fill='toself', mode='lines', name=feature, line={'color': SIGNAL_COLORS[i % len(SIGNAL_COLORS)]},
+            hoverinfo='name'
+        ))
+        q = summary['quantiles'][:, i]
+        fig.add_trace(go.Scatter(
+            x=[i], y=[q[2]], mode='markers', showlegend=False, marker={'color': 'black', 'symbol': 'line-ew-open'},
+            hovertemplate=(f"{feature}<br>median %{{y:.3f}}<br>quartiles {q[1]:.3f} - {q[3]:.3f}"
+                           f"<br>range {q[0]:.3f} - {q[4]:.3f}<extra></extra>")
+        ))
+    fig.update_layout(title='Distribution of Similar Ranged Audio Features from Gathered Songs',
+                      xaxis={'title': 'Features', 'tickvals': list(range(len(summary['features']))),
+                             'ticktext': summary['features']},
+                      yaxis={'title': 'Values'})
+    return fig
+
+
+def frame_digest(df, features=SIGNAL_FEATURES):
+    """
+    Hashes the content of the feature columns, so equal track sets share a key whatever their index.
+    :param df: a pandas DataFrame of tracks and their audio features
+    :param features: the feature columns to hash
+    :return digest: a hex digest
+    """
+    digest = hashlib.sha1(','.join(features).encode())
+    digest.update(pd.util.hash_pandas_object(df[features], index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def _memoized_figure(key, summarize, interactive):
+    # summarize once per key, keeping the most recently used summaries; figures are not thread-safe and
+    # every Streamlit session draws its own, so a fresh one is rendered from the summary on every call
+    with _summaries_lock:
+        summary = _summaries.get(key)
+        if summary is not None:
+            _summaries.move_to_end(key)
+    if summary is None:
+        summary = summarize()
+        with _summaries_lock:
+            _summaries[key] = summary
+            while len(_summaries) > MAX_SUMMARIES:
+                _summaries.popitem(last=False)
+    return render_signal_chart(summary) if interactive else render_signal(summary)
+
+
+def visualize_signal(df, interactive=False, library=None):
+    """
+    Plots the distribution of a track set's audio features. Summaries are memoized by the content of the
+    features, so the same seeds or recommendations are only ever summarized once per process.
+    :param df: a pandas DataFrame of tracks and their audio features
+    :param interactive: return a plotly chart drawn from the summary instead of a matplotlib figure
+    :param library: pass the library when df holds library tracks, e.g. from song_recommendations, to plot
+        them from the library's precomputed bins instead of their raw values
+    :return fig: a matplotlib Figure, or a plotly Figure when interactive
+    """
+    if library is not None and library.store.bins is not None:
+        rows = library.store.positions(df.index)
+        key = ('library', library.version, hashlib.sha1(rows.tobytes()).hexdigest())
+        return _memoized_figure(key, lambda: library_signal_summary(library, rows), interactive)
+    return _memoized_figure((frame_digest(df),), lambda: summarize_signal(df), interactive)
+
+
+def visualize_library_signal(library=None, interactive=False):
+    """
+    Plots the distribution of the whole library's audio features, for comparison with a user's tracks.
+    :param library: a library_cache.LoadedLibrary, defaults to the process-wide one
+    :param interactive: return a plotly chart instead of a matplotlib figure
+    :return fig: a matplotlib Figure, or a plotly Figure when interactive
+    """
+    if library is None:
+        library = library_cache.get_library()
+    return _memoized_figure(('library', library.version, None), lambda: library_signal_summary(library), interactive)
+
+
 ######################################################################################################
 # Model Methods
 ######################################################################################################
@@ -60,46 +265,121 @@ def get_mean_vector(df):
     :param df: a pandas dataframe of individual track and its audio features
     :return mean_vector: a song matrix mean vector to highlight a user's music taste signal
     """
-    # set an empty list for each tracks audio feature values
-    song_vectors = []
-    # iterate through the rows of the given dataframe
-    for index, row in df.iterrows():
-        # append track audio feature values to song vectors list
-        song_vectors.append(row.values)
-    # create a matrix/np array out of song vectors list
-    song_matrix = np.array(list(song_vectors))
-    # calculate the mean of the song_matrix
-    mean_vector = np.mean(song_matrix, axis=0)
+    # take the column-wise mean of the audio feature block directly, no per-row copies
+    mean_vector = df.to_numpy(dtype=np.float64).mean(axis=0)
     # return song vector
     return mean_vector
 
 
 
-def song_recommendations(df):
-    # pull in rec library
-    recommend_library = pd.read_csv("https://myawsbucketdsi221.s3.us-east-2.amazonaws.com/rec_library_full.csv")
-    # pull in pipeline from pickle
-    with open('extended_library.pkl', 'rb') as f:
-        pipeline = pickle.load(f)
-    if df['release_year'].isnull().sum() > 0:
-        df.dropna(axis=0, inplace=True)
+def song_recommendations(df, k=10, index=None, nprobe=ann_index.DEFAULT_NPROBE, library=None, n_centroids=1):
+    """
+    Recommends the k library tracks closest (by cosine distance) to the mean audio profile of df.
+    :param df: a pandas dataframe of the user's tracks and their audio features, or a precomputed TasteProfile
+    :param k: number of recommendations to return
+    :param index: an optional ann_index.IVFIndex over the library, defaults to the one loaded with the library
+    :param nprobe: number of index cells to scan when an index is available
+    :param library: an optional library_cache.LoadedLibrary, defaults to the process-wide warm library
+    :param n_centroids: split the seed tracks into this many KMeans clusters and recommend around each one,
+        so eclectic seeds are not averaged into a single midpoint; 1 uses the mean of all seeds
+    :return recommended_songs_full: the full library rows of the recommended tracks
+    :return recommended_songs: the track_name, artist and release_year of the recommended tracks
+    """
+    # pull in the warm rec library, fitted pipeline and scaled library engine
+    if library is None:
+        library = library_cache.get_library()
     # scaler for data transformation previousl fitted 
-    scaler = pipeline.steps[0][1]
-    # num columns that model was trained on
-    num_columns = df.select_dtypes(np.number).columns
-    # calculate mean_vector to isolate a user's signal
-    mean_vector = get_mean_vector(df[num_columns])
-    # scale recommendation library
-    scaled_data = scaler.transform(recommend_library[num_columns])
+    scaler = library.scaler
+    # num columns that model was trained on, in the order the scaler was fitted with
+    num_columns = library.num_columns
+    # fall back to the index loaded with the library
+    if index is None:
+        index = library.index
+    # an index built over a different library version cannot be trusted, use the exact path instead
+    if index is not None and not library.accepts(index):
+        index = None
+    if isinstance(df, TasteProfile):
+        # a precomputed profile already holds the user's signal
+        mean_vector = df.vector(num_columns)
+    else:
+        if df['release_year'].isnull().sum() > 0:
+            df.dropna(axis=0, inplace=True)
+        if n_centroids > 1 and len(df) > n_centroids:
+            return multi_centroid_recommendations(df, k, n_centroids, library, index, nprobe)
+        # calculate mean_vector to isolate a user's signal
+        mean_vector = get_mean_vector(df[num_columns])
     # scale mean_vector and reshape to 2D Vector
-    scaled_song_center = scaler.transform(mean_vector.reshape(1,-1))
-    # calculate distances between the song center and the track recommendation library
-    distances = cdist(scaled_song_center, scaled_data, 'cosine')
-    # np.argsort(distances) computes the indices that would sort distances in asc order, returns a np array with the same shape
-    # [:, :10] slices the np array to include only the first 10 columns of each row, effectively grabbing the 10 nearest neighbors
-    # [0] selects the first row of the sliced np array
-    # finally we convert it to a list all to get us the indices of the song library that make good recommendations
-    index = list(np.argsort(distances)[:, :10][0])
-    recommended_songs_full = recommend_library.iloc[index]
+    scaled_song_center = scaler.transform(pd.DataFrame(mean_vector.reshape(1,-1), columns=num_columns))
+    if index is not None:
+        # scan only the nprobe cells closest to the song center
+        rows, distances = index.search(scaled_song_center, k=k, nprobe=nprobe)
+    else:
+        # score the pre-normalized library against the song center with one matrix-vector product
+        # and partially select the k nearest neighbors instead of sorting the whole distance row
+        rows, distances = library.engine.query(scaled_song_center, k=k)
+    # materialize only the recommended rows from the columnar library
+    recommended_songs_full = library.store.take(rows)
     recommended_songs = recommended_songs_full[['track_name','artist','release_year']]
     return recommended_songs_full, recommended_songs
+
+
+def multi_centroid_recommendations(df, k, n_centroids, library, index=None, nprobe=ann_index.DEFAULT_NPROBE):
+    """
+    Clusters the seed tracks into n_centroids taste centroids, scores all centroids against the library in
+    one batched scan (or probes each centroid's nearest partitions when an index is given) and merges the
+    per-centroid top-k, giving each centroid a share of the k slots that is proportional to how many seeds
+    it holds.
+    :param df: a pandas dataframe of the user's tracks and their audio features
+    :param k: number of recommendations to return
+    :param n_centroids: number of KMeans clusters to split the seeds into
+    :param library: a library_cache.LoadedLibrary
+    :param index: an optional ann_index.IVFIndex over the library, None scans the whole library exactly
+    :param nprobe: number of index cells to scan per centroid when an index is given
+    :return recommended_songs_full: the full library rows of the recommended tracks
+    :return recommended_songs: the track_name, artist and release_year of the recommended tracks
+    """
+    num_columns = library.num_columns
+    # scale the seeds themselves so the clusters live in the same space as the library
+    seeds = df[num_columns].dropna()
+    scaled_seeds = library.scaler.transform(seeds)
+    kmeans = KMeans(n_clusters=min(n_centroids, len(seeds)), n_init=3, random_state=42).fit(scaled_seeds)
+    if index is not None:
+        # probe only the partitions nearest each centroid, like the single centroid path
+        rows, distances = index.search_batch(kmeans.cluster_centers_, k=k, nprobe=nprobe)
+    else:
+        # score every centroid in one blocked scan of the library
+        rows, distances = library.engine.query_batch(kmeans.cluster_centers_, k=k)
+    # each centroid gets slots in proportion to the seeds it represents
+    quotas = allocate_quotas(np.bincount(kmeans.labels_, minlength=kmeans.n_clusters), k)
+    rows, distances = merge_with_quota(rows, distances, quotas, k)
+    recommended_songs_full = library.store.take(rows)
+    recommended_songs = recommended_songs_full[['track_name','artist','release_year']]
+    return recommended_songs_full, recommended_songs
+
+
+def batch_song_recommendations(profiles, k=10, block_size=BLOCK_SIZE, library=None):
+    """
+    Recommends the k closest library tracks for many users at once, scoring every user profile against the
+    library as one blocked matrix multiply instead of one song_recommendations call per user.
+    :param profiles: a list of TasteProfile objects, or a 2D np array (n_users x n_features) of unscaled mean
+        vectors in the library's num_columns order
+    :param k: number of recommendations per user
+    :param block_size: library rows scored per block, bounds memory to 256 users x block_size scores
+    :param library: an optional library_cache.LoadedLibrary, defaults to the process-wide warm library
+    :return ids: a 2D np array (n_users x k) of recommended track ids (library row positions when the library
+        has no id column), nearest first
+    :return distances: a 2D np array (n_users x k) of the matching cosine distances
+    """
+    if library is None:
+        library = library_cache.get_library()
+    num_columns = library.num_columns
+    # stack every user's signal into one (n_users x n_features) matrix
+    if not isinstance(profiles, np.ndarray):
+        profiles = np.vstack([profile.vector(num_columns) for profile in profiles])
+    # scale all users in one transform
+    scaled_profiles = library.scaler.transform(pd.DataFrame(profiles, columns=num_columns))
+    rows, distances = library.engine.query_batch(scaled_profiles, k=k, block_size=block_size)
+    # report track ids rather than library positions when the library has them
+    if 'id' in library.store.metadata:
+        return library.store.metadata['id'][rows], distances
+    return rows, distances
@@ -2,9 +2,15 @@
 # https://stackoverflow.com/questions/39086287/spotipy-how-to-read-more-than-100-tracks-from-a-playlist
 import spotipy
 import spotipy.oauth2 as oauth2
+import json
+import logging
 import os
 import pandas as pd
 from spotipy.exceptions import SpotifyException
+from app.batch_methods import batched_fetch, iter_pages, paginate, paginate_many, AUDIO_FEATURES_BATCH, ARTISTS_BATCH, MAX_WORKERS, SAVED_TRACKS_PAGE, PLAYLIST_ITEMS_PAGE, PLAYLISTS_PAGE
+from app.chunk_store import ChunkWriter, ChunkedFrame, write_chunks, CHUNK_ROWS
+from app.metadata_cache import get_default_cache
+from app.spotify_client import make_client
 
 # load Spotify OAuth credentials from .env file
 from dotenv import load_dotenv
@@ -13,6 +19,14 @@ CLIENT_ID = os.getenv("SPOTIPY_CLIENT_ID")
 CLIENT_SECRET = os.getenv("SPOTIPY_CLIENT_SECRET")
 REDIRECT_URI = os.getenv("SPOTIPY_REDIRECT_URI")
 
+logger = logging.getLogger(__name__)
+
+# metadata cache namespace of crawled playlists and the snapshot they were crawled at
+PLAYLIST_TRACKS_NAMESPACE = 'playlist_tracks'
+# persisted saved tracks, one chunk directory per user, and the sync state kept next to the chunks
+SAVED_TRACKS_DIR = os.getenv("SONGSUGGEST_SAVED_TRACKS_DIR", "saved_tracks")
+SYNC_STATE_NAME = "sync.json"
+
 ######################################################################################################
 # Authentication Method
 ######################################################################################################
@@ -47,8 +61,8 @@ def authenticate(scope):
         access_token = tokens['access_token']
     # refresh_token = tokens['refresh_token']
 
-    # create a Spotify object using the access token
-    sp = spotipy.Spotify(auth=access_token)
+    # create a rate limited Spotify object using the access token
+    sp = make_client(auth=access_token)
 
     return sp
 
@@ -57,26 +71,29 @@ def authenticate(scope):
 # Playlist Retrieval Methods
 ######################################################################################################
 
+def get_user_playlist_objects(sp):
+    """
+    Retrieves the current user's owned or followed playlists as simplified playlist objects
+    :param sp: a spotipy.Spotify object with an access token for the user
+    :return playlists: a list of playlist dicts with at least id and snapshot_id, each playlist once
+    """
+    # get user's id
+    user_id = sp.current_user()["id"]
+    # get every page of the user's playlists, 50 per page, requesting the pages after the first concurrently
+    playlists = paginate(lambda limit, offset: sp.user_playlists(user=user_id, limit=limit, offset=offset), PLAYLISTS_PAGE)
+    # a playlist both owned and followed is listed once
+    return list({playlist['id']: playlist for playlist in playlists if playlist}.values())
+
+
 def get_user_playlists(sp):
     """
     Retrieves the current user's id and passes it to pull their owned or followed playlists
     :param sp: a spotipy.Spotify object with an access token for the user
     :return playlist_ids: a list of playlist ids
-    :return playlist_names: a list of associated playlist names
     """
-    # get user's id
-    user_id = sp.current_user()["id"]
-    # get the user's playlists
-    playlists = sp.user_playlists(user=user_id)
-    # set empty list of playlist ids
-    playlist_ids = []
-    # set empty list of playlist names
-    playlist_names = []
-    # loop through playlists
-    for playlist in playlists['items']:
-        # append id
-        playlist_ids.append(playlist['id'])
-        
+    # set list of playlist ids
+    playlist_ids = [playlist['id'] for playlist in get_user_playlist_objects(sp)]
+
     return playlist_ids
 
     
@@ -91,16 +108,8 @@ def get_saved_tracks_df(sp):
     :param sp: a spotipy.Spotify object with an access token for the user
     :return df: a pandas DataFrame containing track ID, track name, track artists, track album and other metadata.
     """
-    # sets results to the first call of 20 where offset = 0
-    results = sp.current_user_saved_tracks(limit=20, offset=0)
-    # saves tracks from call by calling items key
-    tracks = results['items']
-    # response returns url to the next page of items, while populated
-    while results['next']:
-        # call next reults 
-        results = sp.next(results)
-        # extend current tracks list by new results
-        tracks.extend(results['items'])
+    # the first page of 50 reveals the total, the remaining pages are requested concurrently by offset
+    tracks = paginate(lambda limit, offset: sp.current_user_saved_tracks(limit=limit, offset=offset), SAVED_TRACKS_PAGE)
     # set new list for flattened observations
     flattened_tracks = []
     # iterate through the tracks
@@ -133,17 +142,9 @@ def get_all_playlist_tracks(sp, playlist_id):
     :param playlist_id: id associated to a specific Spotify playlist
     :return tracks: a list of track objects from the current playlist
     """
-    # results = specific playlist
-    results = sp.playlist_items(playlist_id)
-    # tracks equals items key value pair
-    tracks = results['items']
-    # the playlist_tracks call has a limit of 100,
-    # when there are more tracks, the response contains a next url
-    while results['next']:
-        # the next function takes a previous paged result and generates the next
-        results = sp.next(results)
-        # extend tracks by next call
-        tracks.extend(results['items'])
+    # the playlist_items call has a limit of 100, the first page reveals the total
+    # and the remaining pages are requested concurrently by offset
+    tracks = paginate(lambda limit, offset: sp.playlist_items(playlist_id, limit=limit, offset=offset), PLAYLIST_ITEMS_PAGE)
     # return tracks
     return tracks
 
@@ -178,30 +179,229 @@ def flatten_tracks(tracks):
 
 
 # User Playlist Tracks
-def get_user_playlist_tracks(sp):
+def crawl_user_playlists(sp, max_workers=MAX_WORKERS):
     """
-    Retrieves the user's playlists and tracks for each playlist and adds them to a DataFrame.
+    Crawls every playlist of the user. The playlists are paged through first, then the item pages of all
+    playlists are fetched on one bounded pool, so many small playlists are crawled as fast as one large one.
     :param sp: a spotipy.Spotify object with an access token for the user
-    :param df: a dataframe made up of a user's liked tracks and their audio features
-    :return: a pandas DataFrame containing playlist name, track ID, track name, and track artists
+    :param max_workers: the largest number of item pages in flight at once
+    :return playlist_tracks_df: a pandas DataFrame with one row per track per playlist, tracks shared by
+    several playlists appear once for each with its playlist_id
     """
-    # get lists of playlist ids 
+    # get every playlist id, a playlist both owned and followed is crawled once
     playlist_ids = get_user_playlists(sp)
-    
-    # set new list for flattened tracks
+    return _playlist_tracks_frame(_crawl_playlist_tracks(sp, playlist_ids, max_workers))
+
+
+def _crawl_playlist_tracks(sp, playlist_ids, max_workers=MAX_WORKERS):
+    # the first item page of every playlist reveals its total, the remaining pages of all playlists follow
+    items = paginate_many(lambda playlist_id, limit, offset: sp.playlist_items(playlist_id, limit=limit, offset=offset),
+                          playlist_ids, PLAYLIST_ITEMS_PAGE, max_workers)
+    return {playlist_id: flatten_tracks(playlist_items) for playlist_id, playlist_items in items.items()}
+
+
+def _playlist_tracks_frame(playlist_tracks):
+    # set new list for flattened tracks, tagged with the playlist they came from
     tracks = []
-    # loop through zippled playlist ids and names
-    for playlist_id in playlist_ids:
-        # get tracks from playlist
-        tracks.extend(get_all_playlist_tracks(sp, playlist_id))
-        
-    
-    # turn flattened tracks into pandas df and return
-    playlist_tracks_df = pd.DataFrame(flatten_tracks(tracks))
+    for playlist_id, playlist_items in playlist_tracks.items():
+        for track in playlist_items:
+            tracks.append(dict(track, playlist_id=playlist_id))
+    return pd.DataFrame(tracks)
+
+
+def sync_user_playlists(sp, cache=None, max_workers=MAX_WORKERS):
+    """
+    Crawls the user's playlists incrementally. Every crawled playlist is stored in the metadata cache with
+    the snapshot_id it was read at; a playlist whose snapshot_id has not changed since is served from the
+    cache without a single item request, and only new or edited playlists are crawled.
+    :param sp: a spotipy.Spotify object with an access token for the user
+    :param cache: an optional metadata_cache.MetadataCache, defaults to the process-wide cache
+    :param max_workers: the largest number of item pages in flight at once
+    :return playlist_tracks_df: a pandas DataFrame like crawl_user_playlists returns
+    :return report: a dict of playlists_reused, playlists_fetched, tracks_reused and tracks_fetched
+    """
+    cache = cache or get_default_cache()
+    playlists = get_user_playlist_objects(sp)
+    stored = cache.get_many(PLAYLIST_TRACKS_NAMESPACE, [playlist['id'] for playlist in playlists])
+    # a playlist is reused only when Spotify still reports the snapshot it was crawled at
+    reused = {playlist['id']: stored[playlist['id']]['tracks'] for playlist in playlists
+              if playlist['id'] in stored and playlist.get('snapshot_id')
+              and stored[playlist['id']]['snapshot_id'] == playlist['snapshot_id']}
+    changed = [playlist for playlist in playlists if playlist['id'] not in reused]
+    fetched = _crawl_playlist_tracks(sp, [playlist['id'] for playlist in changed], max_workers)
+    cache.put_many(PLAYLIST_TRACKS_NAMESPACE, {playlist['id']: {'snapshot_id': playlist.get('snapshot_id'),
+                                                                'tracks': fetched[playlist['id']]}
+                                               for playlist in changed})
+    report = {
+        'playlists_reused': len(reused),
+        'playlists_fetched': len(fetched),
+        'tracks_reused': sum(len(tracks) for tracks in reused.values()),
+        'tracks_fetched': sum(len(tracks) for tracks in fetched.values()),
+    }
+    logger.info("Playlist sync reused %(playlists_reused)s playlists (%(tracks_reused)s tracks), "
+                "fetched %(playlists_fetched)s playlists (%(tracks_fetched)s tracks)", report)
+    # keep the playlists in the order Spotify lists them
+    tracks = {playlist['id']: reused.get(playlist['id'], fetched.get(playlist['id'], [])) for playlist in playlists}
+    return _playlist_tracks_frame(tracks), report
 
-        
+def get_user_playlist_tracks(sp):
+    """
+    Retrieves the user's playlists and tracks for each playlist and adds them to a DataFrame.
+    :param sp: a spotipy.Spotify object with an access token for the user
+    :return: a pandas DataFrame containing playlist id, track ID, track name, and track artists
+    """
+    # crawl every playlist that changed since the last visit, the rest come from the cache
+    playlist_tracks_df, report = sync_user_playlists(sp)
     return playlist_tracks_df
 
+
+def get_artist_genres(sp, df):
+    """
+    Adds the genres of each track's artist, fetching every unique artist once.
+    :param sp: a spotipy.Spotify object with an access token for the user
+    :param df: a pandas DataFrame of tracks with an artist_uri column
+    :return df: a copy of df with a genres column of lists
+    """
+    # fetch every unique artist in batches of 50, requesting the batches concurrently
+    artists = batched_fetch(lambda batch: sp.artists(batch)['artists'], df['artist_uri'], ARTISTS_BATCH)
+    df = df.copy()
+    # an artist Spotify did not return gets no genres
+    df['genres'] = [list((artists.get(uri) or {}).get('genres', [])) for uri in df['artist_uri']]
+    return df
+
+
+def enrich_playlist_tracks(sp, df):
+    """
+    Adds audio features and artist genres to crawled playlist tracks. Tracks shared by several playlists
+    are enriched once and the results are joined back onto every playlist row.
+    :param sp: a spotipy.Spotify object with an access token for the user
+    :param df: a pandas DataFrame from crawl_user_playlists
+    :return df: a pandas DataFrame of the playlist rows Spotify returned audio features for
+    """
+    if df.empty:
+        return df
+    # enrich each track once however many playlists share it
+    tracks = df.drop(columns=['playlist_id']).drop_duplicates('id')
+    enriched = get_artist_genres(sp, get_track_audio_features(sp, tracks))
+    # join the enrichment back onto every playlist row, keeping the crawl order
+    columns = ['id'] + [column for column in enriched.columns if column not in df.columns]
+    return pd.merge(df, enriched[columns], on='id', how='inner')
+
+
+def get_enriched_playlist_tracks(sp):
+    """
+    Crawls every playlist of the user and enriches the unique tracks.
+    :param sp: a spotipy.Spotify object with an access token for the user
+    :return df: a pandas DataFrame of playlist tracks with audio features and artist genres
+    """
+    return enrich_playlist_tracks(sp, crawl_user_playlists(sp))
+
+# Saved Tracks Delta Sync
+def _read_sync_state(path, user_id):
+    # the state only counts when it belongs to this user and its chunks were written completely
+    try:
+        with open(os.path.join(path, SYNC_STATE_NAME)) as f:
+            state = json.load(f)
+        ChunkedFrame(path)
+    except (OSError, ValueError):
+        return None
+    # an empty collection is walked in one request anyway
+    return state if state.get('user_id') == user_id and state.get('total') else None
+
+
+def _flatten_saved(items):
+    # saved track items carry the time the user liked the track next to it
+    rows = []
+    for item in items:
+        for row in flatten_tracks([item]):
+            row['added_at'] = item.get('added_at')
+            rows.append(row)
+    return rows
+
+
+def sync_saved_tracks(sp, path=None, full=False):
+    """
+    Refreshes the user's saved tracks incrementally. The saved tracks are persisted as a chunk directory per
+    user together with the added_at watermark of the newest saved item and Spotify's item total. Spotify
+    lists saved tracks newest first, so a later sync pages only until it reaches the watermark, usually one
+    request, and merges the new tracks into the persisted frame. Unliked tracks cannot be seen that way, so
+    when the stored total plus the new items disagrees with Spotify's total the whole collection is walked
+    again. Totals count raw items, so items without a usable track do not force a full walk.
+    :param sp: a spotipy.Spotify object with an access token for the user
+    :param path: the user's chunk directory, defaults to SAVED_TRACKS_DIR/<user id>
+    :param full: ignore the persisted tracks and walk the whole collection
+    :return saved_tracks_df: a pandas DataFrame of the saved tracks, newest first, with an added_at column
+    :return report: a dict of tracks fetched and kept, the number of page requests and whether the sync was full
+    """
+    user_id = sp.current_user()["id"]
+    path = path or os.path.join(SAVED_TRACKS_DIR, user_id)
+    state = None if full else _read_sync_state(path, user_id)
+    if state is None:
+        # nothing to build on, request every page concurrently
+        items = paginate(lambda limit, offset: sp.current_user_saved_tracks(limit=limit, offset=offset), SAVED_TRACKS_PAGE)
+        saved_tracks_df = pd.DataFrame(_flatten_saved(items))
+        total = len(items)
+        watermark = max((item.get('added_at') or '' for item in items), default='')
+        report = {'fetched': len(saved_tracks_df), 'kept': 0, 'requests': -(-len(items) // SAVED_TRACKS_PAGE) or 1, 'full': True}
+    else:
+        known = ChunkedFrame(path).to_frame()
+        known_ids = set(known['id']) if 'id' in known else set()
+        watermark = state['added_at']
+        items = []
+        offset = requests = 0
+        reached = False
+        # page newest first until the first track already known at or before the watermark
+        while not reached:
+            page = sp.current_user_saved_tracks(limit=SAVED_TRACKS_PAGE, offset=offset)
+            requests += 1
+            for item in page['items']:
+                added_at = item.get('added_at') or ''
+                # local or unavailable items can come back without a track
+                track_id = (item.get('track') or {}).get('id')
+                # an item at the watermark without a track cannot be matched, it was counted last time
+                if added_at < watermark or (added_at == watermark and (track_id is None or track_id in known_ids)):
+                    reached = True
+                    break
+                items.append(item)
+            offset += len(page['items'])
+            reached = reached or not page['items'] or offset >= page['total']
+        new_df = pd.DataFrame(_flatten_saved(items))
+        # a re-liked track moves to the top with its new added_at, its old item is gone
+        reliked = sum((item.get('track') or {}).get('id') in known_ids for item in items)
+        if state['total'] + len(items) - reliked != page['total']:
+            logger.info("Saved tracks of %s no longer match the persisted frame, syncing in full", user_id)
+            saved_tracks_df, report = sync_saved_tracks(sp, path, full=True)
+            report['requests'] += requests
+            return saved_tracks_df, report
+        if not items:
+            # nothing new, the persisted frame is already current
+            return known, {'fetched': 0, 'kept': len(known), 'requests': requests, 'full': False}
+        # a collection of only trackless items was persisted as a frame without columns
+        kept = known[~known['id'].isin(new_df['id'])] if len(new_df) and 'id' in known else known
+        saved_tracks_df = pd.concat([new_df, kept], ignore_index=True)
+        total = page['total']
+        watermark = max([watermark] + [item.get('added_at') or '' for item in items])
+        report = {'fetched': len(new_df), 'kept': len(kept), 'requests': requests, 'full': False}
+    # persist the frame first, a state file older than its chunks only makes the next sync page further
+    with ChunkWriter(path) as writer:
+        writer.write_frame(saved_tracks_df)
+    state = {'user_id': user_id, 'added_at': watermark, 'total': total}
+    with open(os.path.join(path, SYNC_STATE_NAME), 'w') as f:
+        json.dump(state, f)
+    logger.info("Saved tracks sync fetched %(fetched)s tracks and kept %(kept)s in %(requests)s requests", report)
+    return saved_tracks_df, report
+
+
+def get_synced_saved_tracks_df(sp):
+    """
+    Retrieves the user's saved tracks through the incremental sync.
+    :param sp: a spotipy.Spotify object with an access token for the user
+    :return df: a pandas DataFrame of the saved tracks, newest first
+    """
+    saved_tracks_df, report = sync_saved_tracks(sp)
+    return saved_tracks_df
+
+
 # Featured Playlists:
 def get_featured_playlist_tracks_df(sp, df):
     """
@@ -222,16 +422,13 @@ def get_track_audio_features(sp, df):
     :param df: a pandas Dataframe containing a given users tracks and associated track metadata features.
     :return tracks_w_features: a pandas DataFrame containing a users tracks, track metadata and track audio features.
     """
-    # Use List Comprehension to get List of all track ids
-    track_ids = [track for track in df['id']]
-    # set list for audio features
-    audio_features = []
-    # iterate through list of track ids 100 at a time to account for api call limit
-    for i in range(0, len(track_ids), 100):
-        # get batch of audio features for each chunk of 100
-        audio_features_batch = sp.audio_features(tracks=track_ids[i:i+100])
-        # add batch to audio features
-        audio_features += audio_features_batch
+    # fetch every unique track id in batches of 100, requesting the batches concurrently
+    audio_features = batched_fetch(lambda batch: sp.audio_features(tracks=batch), df['id'], AUDIO_FEATURES_BATCH)
+    # keep the tracks Spotify returned features for
+    audio_features = [features for features in audio_features.values() if features is not None]
+    if not audio_features:
+        # an inner merge with no features keeps no tracks
+        return df.iloc[0:0]
     # turn audio features into a df
     audio_features_df = pd.DataFrame(audio_features)
     # drop columns we dont need
@@ -241,6 +438,85 @@ def get_track_audio_features(sp, df):
     # return df
     return tracks_w_features
 
+######################################################################################################
+# Streaming Ingestion Methods
+######################################################################################################
+# get_saved_tracks_df and get_user_playlist_tracks hold every raw page before building their frame. For
+# large libraries the methods below flatten each page as it arrives and write it to columnar chunks on
+# disk (see app/chunk_store.py), then enrich the chunks one at a time, so memory stays bounded by a chunk.
+
+def iter_saved_track_pages(sp):
+    """
+    Yields the user's saved tracks one flattened page at a time.
+    :param sp: a spotipy.Spotify object with an access token for the user
+    :return pages: a generator of lists of flattened tracks
+    """
+    for items in iter_pages(lambda limit, offset: sp.current_user_saved_tracks(limit=limit, offset=offset), SAVED_TRACKS_PAGE):
+        yield flatten_tracks(items)
+
+
+def iter_playlist_track_pages(sp):
+    """
+    Yields the unique tracks of every playlist of the user one flattened page at a time.
+    :param sp: a spotipy.Spotify object with an access token for the user
+    :return pages: a generator of lists of flattened tracks
+    """
+    # a track already streamed from an earlier playlist is not written again
+    seen = set()
+    for playlist_id in get_user_playlists(sp):
+        for items in iter_pages(lambda limit, offset: sp.playlist_items(playlist_id, limit=limit, offset=offset), PLAYLIST_ITEMS_PAGE):
+            tracks = [track for track in flatten_tracks(items) if track['id'] not in seen]
+            seen.update(track['id'] for track in tracks)
+            yield tracks
+
+
+def stream_saved_tracks(sp, path, chunk_rows=CHUNK_ROWS):
+    """
+    Writes the user's saved tracks to a chunk directory without holding the library in memory.
+    :param sp: a spotipy.Spotify object with an access token for the user
+    :param path: destination chunk directory
+    :param chunk_rows: tracks per chunk
+    :return chunks: a chunk_store.ChunkedFrame of the saved tracks
+    """
+    return write_chunks(iter_saved_track_pages(sp), path, chunk_rows)
+
+
+def stream_user_playlist_tracks(sp, path, chunk_rows=CHUNK_ROWS):
+    """
+    Writes the tracks of every playlist of the user to a chunk directory without holding them in memory.
+    :param sp: a spotipy.Spotify object with an access token for the user
+    :param path: destination chunk directory
+    :param chunk_rows: tracks per chunk
+    :return chunks: a chunk_store.ChunkedFrame of the playlist tracks
+    """
+    return write_chunks(iter_playlist_track_pages(sp), path, chunk_rows)
+
+
+def iter_track_audio_features(sp, chunks):
+    """
+    Lazily adds audio features to each chunk of tracks.
+    :param sp: a spotipy.Spotify object with an access token for the user
+    :param chunks: a chunk_store.ChunkedFrame, or any iterable of track dataframes
+    :return frames: a generator of pandas DataFrames of tracks with their audio features
+    """
+    for df in chunks:
+        yield get_track_audio_features(sp, df)
+
+
+def stream_track_audio_features(sp, chunks, path):
+    """
+    Adds audio features to every chunk of tracks and writes the results to a new chunk directory.
+    :param sp: a spotipy.Spotify object with an access token for the user
+    :param chunks: a chunk_store.ChunkedFrame of tracks
+    :param path: destination chunk directory
+    :return chunks: a chunk_store.ChunkedFrame of tracks with their audio features
+    """
+    with ChunkWriter(path) as writer:
+        for df in iter_track_audio_features(sp, chunks):
+            writer.write_frame(df)
+    return ChunkedFrame(path)
+
+
 ######################################################################################################
 # Handler Methods
 ######################################################################################################
@@ -254,12 +530,18 @@ FUNCTION_MAP = {
     "get_saved_tracks": {'function': get_saved_tracks_df,
                          'scope': 'user-library-read',
                          'params': 'no'},
+    "sync_saved_tracks": {'function': get_synced_saved_tracks_df,
+                          'scope': 'user-library-read',
+                          'params': 'no'},
     "get_track_audio_features": {'function': get_track_audio_features,
                                  'scope': 'user-library-read',
                                  'params': 'yes'},
     "get_user_playlist_tracks": {'function': get_user_playlist_tracks,
                                'scope': 'user-library-read playlist-read-private',
                                  'params': 'no'},
+    "get_enriched_playlist_tracks": {'function': get_enriched_playlist_tracks,
+                                     'scope': 'user-library-read playlist-read-private',
+                                     'params': 'no'},
 }
 
 def handler(identifier, df=None):